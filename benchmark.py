@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Benchmarks for RL memory code."""
+
+import os
+import subprocess
+import sys
+from multiprocessing import Barrier, Process, Queue
+from os.path import dirname, realpath, exists, join as join_path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+
+DIRECTORY = dirname(realpath(__file__))
+sys.path.insert(0, dirname(DIRECTORY))
+
+# pylint: disable = wrong-import-position
+from research.rl_memory import NaiveDictKB, NetworkXKB
+from research.kb_server import spawn_knowledge_store_server, KnowledgeStoreClient
+
+STARTUP_SCRIPT = '''
+import sys
+from time import perf_counter
+start = perf_counter()
+from research.rl_environments import State, Environment
+from research.rl_memory import memory_architecture
+imported = perf_counter()
+
+class StartupEnv(Environment):
+    def get_state(self):
+        return State()
+    def get_observation(self):
+        return State()
+    def get_actions(self):
+        return []
+    def reset(self):
+        pass
+    def start_new_episode(self):
+        pass
+    def react(self, action):
+        return 0
+    def visualize(self):
+        pass
+
+env = memory_architecture(StartupEnv)()
+env.start_new_episode()
+created = perf_counter()
+print(imported - start, created - imported, 'networkx' in sys.modules, 'numpy' in sys.modules)
+'''
+
+
+def benchmark_startup(repetitions=20):
+    """Time importing rl_memory and creating the first environment in a fresh process.
+
+    Arguments:
+        repetitions (int): The number of processes to start. Defaults to 20.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([dirname(DIRECTORY), env.get('PYTHONPATH', '')])
+    import_times = []
+    create_times = []
+    for _ in range(repetitions):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout.split()
+        import_times.append(float(output[0]))
+        create_times.append(float(output[1]))
+        loaded = output[2:]
+    print(f'import rl_memory: {1000 * median(import_times):.2f} ms (median of {repetitions})')
+    print(f'first environment: {1000 * median(create_times):.2f} ms (median of {repetitions})')
+    print(f'networkx loaded: {loaded[0]}, numpy loaded: {loaded[1]}')
+
+
+def _grid_store(store_class, size):
+    store = store_class()
+    for i in range(size * size):
+        store.store(f'cell{i}', index=i, row=(i // size), col=(i % size))
+    return store
+
+
+def _browse(store, size, num_requests, ready, latencies):
+    # wait until every client has its store, so that only requests are timed
+    ready.wait()
+    times = []
+    for i in range(num_requests):
+        start = perf_counter()
+        store.query({'row': i % size})
+        store.next_result()
+        times.append(perf_counter() - start)
+    latencies.put(times)
+
+
+def _browse_local(store_class, size, num_requests, ready, latencies):
+    _browse(_grid_store(store_class, size), size, num_requests, ready, latencies)
+
+
+def _browse_remote(address, authkey, size, num_requests, ready, latencies):
+    while not exists(address):
+        sleep(0.01)
+    _browse(KnowledgeStoreClient(address, authkey), size, num_requests, ready, latencies)
+
+
+def _run_clients(target, args, num_clients, num_requests):
+    ready = Barrier(num_clients + 1)
+    latencies = Queue()
+    processes = [
+        Process(target=target, args=(*args, num_requests, ready, latencies))
+        for _ in range(num_clients)
+    ]
+    for process in processes:
+        process.start()
+    ready.wait()
+    start = perf_counter()
+    times = []
+    for _ in processes:
+        times.extend(latencies.get())
+    seconds = perf_counter() - start
+    for process in processes:
+        process.join()
+    times.sort()
+    return (
+        len(times) / seconds,
+        times[len(times) // 2],
+        times[min(len(times) - 1, int(len(times) * 0.99))],
+    )
+
+
+def benchmark_kb_server(client_counts=(1, 2, 4, 8), num_requests=1000, size=30):
+    """Compare a shared knowledge store server with a store in every process.
+
+    Each request is a query followed by a next result. Every client builds
+    its own store or connects to the server before any client starts, so
+    only the requests are timed.
+
+    Arguments:
+        client_counts (Sequence[int]): The numbers of client processes to try.
+        num_requests (int): The number of requests per client. Defaults to 1000.
+        size (int): The side of the grid of elements in the store. Defaults to 30.
+    """
+    for store_class in (NaiveDictKB, NetworkXKB):
+        for num_clients in client_counts:
+            throughput, p50, p99 = _run_clients(
+                _browse_local, (store_class, size), num_clients, num_requests,
+            )
+            print(
+                f'{store_class.__name__} in-process, {num_clients} clients: '
+                f'{throughput:.0f} requests/s, p50 {1e6 * p50:.0f} us, p99 {1e6 * p99:.0f} us'
+            )
+            with TemporaryDirectory() as temp_dir:
+                address = join_path(temp_dir, 'kb.sock')
+                server, authkey = spawn_knowledge_store_server(_grid_store(store_class, size), address)
+                throughput, p50, p99 = _run_clients(
+                    _browse_remote, (address, authkey, size), num_clients, num_requests,
+                )
+                server.terminate()
+                server.join()
+            print(
+                f'{store_class.__name__} server, {num_clients} clients: '
+                f'{throughput:.0f} requests/s, p50 {1e6 * p50:.0f} us, p99 {1e6 * p99:.0f} us'
+            )
+
+
+def main():
+    benchmark_startup()
+    benchmark_kb_server()
+
+
+if __name__ == '__main__':
+    main()
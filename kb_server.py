@@ -0,0 +1,287 @@
+"""A knowledge store server shared by many processes."""
+
+import os
+import pickle
+from collections import namedtuple
+from multiprocessing import AuthenticationError, Process
+from multiprocessing.connection import Listener, Client
+from queue import Queue, Empty
+from secrets import token_bytes
+from threading import Thread
+
+from .rl_memory import KnowledgeStore
+
+Request = namedtuple('Request', 'client, method, args, kwargs')
+
+
+class KnowledgeStoreServer:
+    """A server that owns one knowledge store and serves many clients.
+
+    Each connection is read by its own thread, which only queues requests. A
+    single dispatcher thread takes whatever requests have arrived as a batch,
+    runs them against the store, and replies. Every client has its own result
+    cursor, which is swapped into the store before its requests are run, and
+    which skips the elements that other clients caused to be evicted. Identical read-only requests in a batch, with no other requests between
+    them that could change the store, are only run once.
+
+    Clients must authenticate with the server's authkey, since requests are
+    unpickled by the server. If no authkey is given, a random one is
+    generated, and the socket is only accessible by the user running the
+    server.
+    """
+
+    METHODS = set([
+        'clear', 'store', 'retrieve', 'query', 'partial_query', 'iter_query', 'explain',
+        'has_prev_result', 'prev_result', 'has_next_result', 'next_result',
+    ])
+
+    # methods that neither use the cursor nor change the store
+    READ_METHODS = set(['iter_query', 'explain'])
+
+    def __init__(self, knowledge_store, address, max_batch_size=64, authkey=None):
+        """Initialize the KnowledgeStoreServer.
+
+        Arguments:
+            knowledge_store (KnowledgeStore): The store to serve.
+            address (str): The path of the Unix socket to listen on.
+            max_batch_size (int): The maximum number of requests per batch. Defaults to 64.
+            authkey (bytes): The key clients must authenticate with. Defaults to None,
+                for a random key.
+        """
+        # parameters
+        self.knowledge_store = knowledge_store
+        self.address = address
+        self.max_batch_size = max_batch_size
+        if authkey is None:
+            authkey = token_bytes(32)
+        self.authkey = authkey
+        # variables
+        self.listener = None
+        self.requests = Queue()
+        self.cursors = {}
+        self.threads = []
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_shared = 0
+
+    def start(self):
+        """Start serving in background threads.
+
+        Returns:
+            KnowledgeStoreServer: This server.
+        """
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        for target in (self._accept, self._dispatch):
+            thread = Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def serve_forever(self):
+        """Serve until the process is terminated."""
+        self.start()
+        for thread in self.threads:
+            thread.join()
+
+    def shutdown(self):
+        """Stop accepting connections and stop the dispatcher."""
+        self.requests.put(None)
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+
+    def _accept(self):
+        while self.listener is not None:
+            try:
+                connection = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                return
+            connection.send(type(self.knowledge_store))
+            Thread(target=self._receive, args=(connection,), daemon=True).start()
+
+    def _receive(self, connection):
+        while True:
+            try:
+                method, args, kwargs = connection.recv()
+            except (EOFError, OSError):
+                self.requests.put(Request(connection, None, None, None))
+                return
+            self.requests.put(Request(connection, method, args, kwargs))
+
+    def _dispatch(self):
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except Empty:
+                    break
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            shared = {}
+            for request in batch:
+                if request is None:
+                    return
+                if request.method in self.READ_METHODS:
+                    key = pickle.dumps(request[1:])
+                    if key not in shared:
+                        shared[key] = self._run(request)
+                    else:
+                        self.num_shared += 1
+                    self._respond(request, shared[key])
+                else:
+                    # any other request may change what the reads would return
+                    shared.clear()
+                    self._handle(request)
+
+    def _run(self, request):
+        try:
+            result = getattr(self.knowledge_store, request.method)(*request.args, **request.kwargs)
+            if request.method == 'iter_query':
+                result = list(result)
+            return (True, result)
+        except Exception as error: # pylint: disable = broad-except
+            return (False, error)
+
+    def _handle(self, request):
+        if request.method is None:
+            self.cursors.pop(request.client, None)
+            return
+        store = self.knowledge_store
+        try:
+            if request.method not in self.METHODS:
+                raise ValueError(f'{request.method} is not a knowledge store method')
+            store.set_cursor(self.cursors.get(request.client))
+            attribute = getattr(store, request.method)
+            if request.args is None:
+                result = attribute
+            else:
+                result = attribute(*request.args, **request.kwargs)
+            self.cursors[request.client] = store.get_cursor()
+            response = (True, result)
+        except Exception as error: # pylint: disable = broad-except
+            response = (False, error)
+        self._respond(request, response)
+
+    def _respond(self, request, response):
+        try:
+            request.client.send(response)
+        except OSError:
+            self.cursors.pop(request.client, None)
+
+
+def spawn_knowledge_store_server(knowledge_store, address, authkey=None, **kwargs):
+    """Start a KnowledgeStoreServer in a separate process.
+
+    Arguments:
+        knowledge_store (KnowledgeStore): The store to serve.
+        address (str): The path of the Unix socket to listen on.
+        authkey (bytes): The key clients must authenticate with. Defaults to None,
+            for a random key.
+        **kwargs: Arbitrary keyword arguments for the KnowledgeStoreServer.
+
+    Returns:
+        Tuple[multiprocessing.Process, bytes]: The server process and its authkey.
+    """
+    if authkey is None:
+        authkey = token_bytes(32)
+    process = Process(
+        target=_serve,
+        args=(knowledge_store, address),
+        kwargs={'authkey': authkey, **kwargs},
+        daemon=True,
+    )
+    process.start()
+    return process, authkey
+
+
+def _serve(knowledge_store, address, **kwargs):
+    KnowledgeStoreServer(knowledge_store, address, **kwargs).serve_forever()
+
+
+class KnowledgeStoreClient(KnowledgeStore):
+    """A proxy for a knowledge store owned by a KnowledgeStoreServer."""
+
+    def __init__(self, address, authkey):
+        """Initialize the KnowledgeStoreClient.
+
+        Arguments:
+            address (str): The path of the server's Unix socket.
+            authkey (bytes): The server's authkey.
+        """
+        # parameters
+        self.address = address
+        self.authkey = authkey
+        # variables
+        self.connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self.store_class = self.connection.recv()
+
+    def close(self):
+        """Disconnect from the server."""
+        self.connection.close()
+
+    def __getstate__(self):
+        return {'address': self.address, 'authkey': self.authkey}
+
+    def __setstate__(self, state):
+        self.__init__(state['address'], state['authkey'])
+
+    def _request(self, method, args, kwargs):
+        self.connection.send((method, args, kwargs))
+        success, result = self.connection.recv()
+        if not success:
+            raise result
+        return result
+
+    def _call(self, method, *args, **kwargs):
+        return self._request(method, args, kwargs)
+
+    def clear(self): # noqa: D102
+        self._call('clear')
+
+    def store(self, mem_id=None, **kwargs): # noqa: D102
+        return self._call('store', mem_id, **kwargs)
+
+    def retrieve(self, mem_id): # noqa: D102
+        return self._call('retrieve', mem_id)
+
+    def query(self, attr_vals): # noqa: D102
+        return self._call('query', dict(attr_vals.items()))
+
+    def iter_query(self, attr_vals, limit=None): # noqa: D102
+        # the results are fetched in one round trip
+        yield from self._call('iter_query', dict(attr_vals.items()), limit=limit)
+
+    def partial_query(self, attr_vals, k=10, activation_weight=0.0, mismatch_penalty=1.0): # noqa: D102
+        return self._call(
+            'partial_query', dict(attr_vals.items()),
+            k=k, activation_weight=activation_weight, mismatch_penalty=mismatch_penalty,
+        )
+
+    def explain(self, attr_vals): # noqa: D102
+        return self._call('explain', dict(attr_vals.items()))
+
+    @property
+    def has_prev_result(self): # noqa: D102
+        return self._request('has_prev_result', None, None)
+
+    def prev_result(self): # noqa: D102
+        return self._call('prev_result')
+
+    @property
+    def has_next_result(self): # noqa: D102
+        return self._request('has_next_result', None, None)
+
+    def next_result(self): # noqa: D102
+        return self._call('next_result')
+
+    def retrievable(self, mem_id): # noqa: D102
+        # pylint: disable = arguments-differ
+        return self.store_class.retrievable(mem_id)
+
+    def fork(self): # noqa: D102
+        # a new connection has its own cursor on the same store
+        return KnowledgeStoreClient(self.address, self.authkey)
@@ -1,15 +1,43 @@
 """Memory architecture for reinforcement learning."""
 
-from collections import namedtuple, defaultdict
-from collections.abc import Hashable
+import gzip
+import pickle
+from collections import namedtuple, defaultdict, Counter, OrderedDict
+from collections.abc import Hashable, Mapping, MutableMapping
+from numbers import Integral
+from copy import copy, deepcopy
+from heapq import heappush, heappop, heapify
+from importlib import import_module
+from itertools import count, islice
+from sys import getsizeof
+from time import perf_counter
 from uuid import uuid4 as uuid
-
-from networkx import MultiDiGraph
+from weakref import WeakValueDictionary
 
 from .rl_environments import State, Action, Environment
 from .data_structures import TreeMultiMap
 
 
+class _LazyModule:
+    """A module that is only imported once one of its attributes is used."""
+
+    def __init__(self, name, package=None):
+        self._name = name
+        self._package = package
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = import_module(self._name, self._package)
+        return getattr(self._module, attr)
+
+
+# backends are only loaded when a knowledge store that needs them is used
+networkx = _LazyModule('networkx')
+np = _LazyModule('numpy')
+knowledge_base = _LazyModule('.knowledge_base', __package__)
+
+
 def memory_architecture(cls):
     """Decorate an Environment to become a memory architecture.
 
@@ -24,6 +52,7 @@ def memory_architecture(cls):
 
     # pylint: disable = invalid-name
     BufferProperties = namedtuple('BufferProperties', ['copyable', 'writable'])
+    MemorySnapshot = namedtuple('MemorySnapshot', ['buffers', 'internal_action_count', 'knowledge'])
 
     class MemoryArchitectureMetaEnvironment(cls):
         """A subclass to add a long-term memory to an Environment."""
@@ -59,7 +88,8 @@ def memory_architecture(cls):
                 buf_ignore (Iterable[str]): Buffers that should not be created.
                 internal_reward (float): Reward for internal actions. Defaults to -0.1.
                 max_internal_actions (int): Max number of consecutive internal actions. Defaults to None.
-                knowledge_store (KnowledgeStore): The memory model to use.
+                knowledge_store (Union[KnowledgeStore, str]): The memory model to use,
+                    or the registered name of one. Defaults to a NaiveDictKB.
                 *args: Arbitrary positional arguments.
                 **kwargs: Arbitrary keyword arguments.
             """
@@ -71,11 +101,15 @@ def memory_architecture(cls):
             self.internal_reward = internal_reward
             self.max_internal_actions = max_internal_actions
             # infrastructure
+            self.codec = IntegerCodec()
             if knowledge_store is None:
                 knowledge_store = NaiveDictKB()
+            elif isinstance(knowledge_store, str):
+                knowledge_store = create_knowledge_store(knowledge_store)
             self.knowledge_store = knowledge_store
             # variables
             self.buffers = {}
+            self.shared_buffers = set()
             self.internal_action_count = 0
             # initialization
             self._clear_buffers()
@@ -111,14 +145,73 @@ def memory_architecture(cls):
 
         def _clear_buffers(self):
             self.buffers = {}
+            self.shared_buffers = set()
             for buf, _ in self.BUFFERS.items():
                 if buf in self.buf_ignore:
                     continue
                 self.buffers[buf] = TreeMultiMap()
 
         def _clear_ltm_buffers(self):
-            self.buffers['query'].clear()
-            self.buffers['retrieval'].clear()
+            self.buffers['query'] = TreeMultiMap()
+            self.buffers['retrieval'] = TreeMultiMap()
+
+        def _writable_buffer(self, buf):
+            # copy a buffer shared with a snapshot or fork before modifying it
+            if buf in self.shared_buffers:
+                self.buffers[buf] = _copy_multimap(self.buffers[buf])
+                self.shared_buffers.discard(buf)
+            return self.buffers[buf]
+
+        def snapshot(self):
+            """Capture the state of the buffers and the long-term memory.
+
+            The buffers are not copied until they are next modified, and the
+            knowledge store only records what changes afterwards, so taking a
+            snapshot does not depend on the size of the long-term memory. The
+            state of the decorated environment itself is not included.
+
+            Returns:
+                MemorySnapshot: The captured state.
+            """
+            self.shared_buffers = set(self.buffers)
+            return MemorySnapshot(
+                dict(self.buffers),
+                self.internal_action_count,
+                self.knowledge_store.snapshot(),
+            )
+
+        def restore(self, snapshot):
+            """Return the buffers and the long-term memory to a snapshot.
+
+            Arguments:
+                snapshot (MemorySnapshot): A snapshot taken from this environment.
+            """
+            self.buffers = dict(snapshot.buffers)
+            self.shared_buffers = set(self.buffers)
+            self.internal_action_count = snapshot.internal_action_count
+            self.knowledge_store.restore(snapshot.knowledge)
+
+        def fork(self):
+            """Create an independent copy of this environment.
+
+            The buffers are shared with the copy until either modifies them,
+            and the knowledge store is forked as cheaply as it allows. The
+            state of the decorated environment is copied deeply, except for
+            the codec, which is shared so that action IDs agree across forks.
+
+            Returns:
+                MemoryArchitectureMetaEnvironment: The copy.
+            """
+            memo = {
+                id(value): value
+                for value in (self.buffers, self.codec, self.knowledge_store)
+            }
+            forked = deepcopy(self, memo)
+            self.shared_buffers = set(self.buffers)
+            forked.buffers = dict(self.buffers)
+            forked.shared_buffers = set(self.buffers)
+            forked.knowledge_store = self.knowledge_store.fork()
+            return forked
 
         def start_new_episode(self): # noqa: D102
             # pylint: disable = missing-docstring
@@ -133,19 +226,83 @@ def memory_architecture(cls):
             if actions == []:
                 return actions
             actions = set(actions)
-            allow_internal_actions = (
+            if self._allow_internal_actions():
+                actions.update(
+                    self.codec.internal_action(key)
+                    for key in self._generate_internal_keys()
+                )
+            return sorted(actions)
+
+        def get_action_ids(self):
+            """Get the IDs of the available actions.
+
+            Unlike get_actions(), this does not create or sort Action objects
+            for internal actions that have been seen before.
+
+            Returns:
+                numpy.ndarray: The sorted integer IDs of the available actions.
+            """
+            actions = super().get_actions()
+            if actions == []:
+                return np.zeros(0, dtype=np.int64)
+            action_ids = set(self.codec.encode_action(action) for action in actions)
+            if self._allow_internal_actions():
+                action_ids.update(
+                    self.codec.encode_internal_action(key)
+                    for key in self._generate_internal_keys()
+                )
+            return np.array(sorted(action_ids), dtype=np.int64)
+
+        def get_action_mask(self, size=None):
+            """Get which actions are available, indexed by action ID.
+
+            Action IDs are assigned as actions are first seen, so by default
+            the mask grows as new actions become available. Learners with
+            arrays of a fixed size should pass that size instead.
+
+            Arguments:
+                size (int): The length of the mask. Defaults to None, for the
+                    number of actions seen so far.
+
+            Returns:
+                numpy.ndarray: A boolean array over action IDs.
+
+            Raises:
+                ValueError: If an available action has an ID outside the mask.
+            """
+            action_ids = self.get_action_ids()
+            if size is None:
+                size = self.codec.num_actions
+            elif len(action_ids) and action_ids[-1] >= size:
+                raise ValueError(f'action ID {action_ids[-1]} does not fit in a mask of size {size}')
+            mask = np.zeros(size, dtype=bool)
+            mask[action_ids] = True
+            return mask
+
+        def get_observation_ids(self):
+            """Get the IDs of the buffer slots in the current observation.
+
+            Returns:
+                numpy.ndarray: The sorted integer IDs of the buffer, attribute, and value slots.
+            """
+            return np.array(
+                sorted(self.codec.encode_slot(slot) for slot in self.slots),
+                dtype=np.int64,
+            )
+
+        def _allow_internal_actions(self):
+            return (
                 self.max_internal_actions is None
                 or self.internal_action_count < self.max_internal_actions
             )
-            if allow_internal_actions:
-                actions.update(self._generate_copy_actions())
-                actions.update(self._generate_delete_actions())
-                actions.update(self._generate_retrieve_actions())
-                actions.update(self._generate_cursor_actions())
-            return sorted(actions)
 
-        def _generate_copy_actions(self):
-            actions = []
+        def _generate_internal_keys(self):
+            yield from self._generate_copy_keys()
+            yield from self._generate_delete_keys()
+            yield from self._generate_retrieve_keys()
+            yield from self._generate_cursor_keys()
+
+        def _generate_copy_keys(self):
             for src_buf, src_props in self.BUFFERS.items():
                 if src_buf in self.buf_ignore or not src_props.copyable:
                     continue
@@ -160,51 +317,38 @@ def memory_architecture(cls):
                         )
                         if not copyable:
                             continue
-                        actions.append(Action(
-                            'copy',
-                            src_buf=src_buf,
-                            src_attr=attr,
-                            dst_buf=dst_buf,
-                            dst_attr=attr,
-                        ))
-            return actions
-
-        def _generate_delete_actions(self):
-            actions = []
+                        yield ('copy', src_buf, attr, dst_buf, attr)
+
+        def _generate_delete_keys(self):
             for buf, prop in self.BUFFERS.items():
                 if buf in self.buf_ignore or not prop.writable:
                     continue
                 for attr in self.buffers[buf]:
-                    actions.append(Action(
-                        'delete',
-                        buf=buf,
-                        attr=attr,
-                    ))
-            return actions
-
-        def _generate_retrieve_actions(self):
-            actions = []
+                    yield ('delete', buf, attr)
+
+        def _generate_retrieve_keys(self):
             for buf, buf_props in self.BUFFERS.items():
                 if buf in self.buf_ignore or not buf_props.copyable:
                     continue
                 for attr, value in self.buffers[buf].items():
                     if self.knowledge_store.retrievable(value):
-                        actions.append(Action('retrieve', buf=buf, attr=attr))
-            return actions
+                        yield ('retrieve', buf, attr)
 
-        def _generate_cursor_actions(self):
-            actions = []
+        def _generate_cursor_keys(self):
             if self.buffers['retrieval']:
                 if self.knowledge_store.has_prev_result:
-                    actions.append(Action('prev-result'))
+                    yield ('prev-result',)
                 if self.knowledge_store.has_next_result:
-                    actions.append(Action('next-result'))
-            return actions
+                    yield ('next-result',)
 
         def react(self, action): # noqa: D102
             # pylint: disable = missing-docstring
             # handle internal actions and update internal buffers
-            assert action in self.get_actions(), f'{action} not in {self.get_actions()}'
+            if isinstance(action, Integral):
+                assert action in self.get_action_ids(), f'{action} not in {self.get_action_ids()}'
+                action = self.codec.decode_action(action)
+            else:
+                assert action in self.get_actions(), f'{action} not in {self.get_actions()}'
             external_action = self._process_internal_actions(action)
             if external_action:
                 reward = super().react(action)
@@ -226,18 +370,18 @@ def memory_architecture(cls):
             """
             if action.name == 'copy':
                 val = self.buffers[action.src_buf][action.src_attr]
-                self.buffers[action.dst_buf][action.dst_attr] = val
+                self._writable_buffer(action.dst_buf)[action.dst_attr] = val
                 if action.dst_buf == 'query':
                     self._query_ltm()
             elif action.name == 'delete':
-                del self.buffers[action.buf][action.attr]
+                del self._writable_buffer(action.buf)[action.attr]
                 if action.buf == 'query':
                     self._query_ltm()
             elif action.name == 'retrieve':
                 result = self.knowledge_store.retrieve(self.buffers[action.buf][action.attr])
-                self.buffers['query'].clear()
+                self.buffers['query'] = TreeMultiMap()
                 if result is None:
-                    self.buffers['retrieval'].clear()
+                    self.buffers['retrieval'] = TreeMultiMap()
                 else:
                     self.buffers['retrieval'] = result
             elif action.name == 'prev-result':
@@ -250,17 +394,18 @@ def memory_architecture(cls):
 
         def _query_ltm(self):
             if not self.buffers['query']:
-                self.buffers['retrieval'].clear()
+                self.buffers['retrieval'] = TreeMultiMap()
                 return
             result = self.knowledge_store.query(self.buffers['query'])
             if result is None:
-                self.buffers['retrieval'].clear()
+                self.buffers['retrieval'] = TreeMultiMap()
             else:
                 self.buffers['retrieval'] = result
 
         def _sync_input_buffers(self):
             # update input buffers
             self.buffers['perceptual'] = super().get_observation()
+            self.shared_buffers.discard('perceptual')
 
         def add_to_ltm(self, **kwargs):
             """Add a memory element to long-term memory.
@@ -273,6 +418,145 @@ def memory_architecture(cls):
     return MemoryArchitectureMetaEnvironment
 
 
+class IntegerCodec:
+    """A mapping between actions or buffer slots and dense integer IDs.
+
+    IDs are assigned in the order that actions and slots are first seen and
+    never change afterwards, so they can index flat arrays of values. Since
+    new IDs keep being assigned as new actions become available, arrays
+    indexed by ID either grow or are allocated with a fixed maximum size.
+    Known actions can be given IDs up front with encode_action().
+    """
+
+    def __init__(self):
+        """Initialize the IntegerCodec."""
+        self.action_ids = {} # Action -> id
+        self.actions = [] # id -> Action
+        self.internal_action_ids = {} # key -> id
+        self.slot_ids = {} # (buffer, attribute, value) -> id
+        self.slots = [] # id -> (buffer, attribute, value)
+
+    @property
+    def num_actions(self):
+        """Get the number of actions with IDs.
+
+        Returns:
+            int: The number of actions.
+        """
+        return len(self.actions)
+
+    @property
+    def num_slots(self):
+        """Get the number of slots with IDs.
+
+        Returns:
+            int: The number of slots.
+        """
+        return len(self.slots)
+
+    def encode_action(self, action):
+        """Get the ID of an action, assigning one if necessary.
+
+        Arguments:
+            action (Action): The action.
+
+        Returns:
+            int: The ID of the action.
+        """
+        action_id = self.action_ids.get(action)
+        if action_id is None:
+            action_id = len(self.actions)
+            self.action_ids[action] = action_id
+            self.actions.append(action)
+        return action_id
+
+    def decode_action(self, action_id):
+        """Get the action with an ID.
+
+        Arguments:
+            action_id (int): The ID of the action.
+
+        Returns:
+            Action: The action.
+        """
+        return self.actions[action_id]
+
+    def encode_internal_action(self, key):
+        """Get the ID of an internal action, without creating it if it has an ID.
+
+        Arguments:
+            key (Tuple[str, ...]): The name of the action followed by its buffers and attributes.
+
+        Returns:
+            int: The ID of the action.
+        """
+        action_id = self.internal_action_ids.get(key)
+        if action_id is None:
+            action_id = self.encode_action(self.internal_action(key))
+            self.internal_action_ids[key] = action_id
+        return action_id
+
+    @staticmethod
+    def internal_action(key):
+        """Create an internal action.
+
+        Arguments:
+            key (Tuple[str, ...]): The name of the action followed by its buffers and attributes.
+
+        Returns:
+            Action: The action.
+        """
+        name = key[0]
+        if name == 'copy':
+            _, src_buf, src_attr, dst_buf, dst_attr = key
+            return Action(
+                'copy',
+                src_buf=src_buf,
+                src_attr=src_attr,
+                dst_buf=dst_buf,
+                dst_attr=dst_attr,
+            )
+        elif name in ('delete', 'retrieve'):
+            _, buf, attr = key
+            return Action(name, buf=buf, attr=attr)
+        else:
+            return Action(name)
+
+    def encode_slot(self, slot):
+        """Get the ID of a buffer slot, assigning one if necessary.
+
+        Arguments:
+            slot (Tuple[str, str, Any]): The buffer, attribute, and value.
+
+        Returns:
+            int: The ID of the slot.
+        """
+        slot_id = self.slot_ids.get(slot)
+        if slot_id is None:
+            slot_id = len(self.slots)
+            self.slot_ids[slot] = slot_id
+            self.slots.append(slot)
+        return slot_id
+
+    def decode_slot(self, slot_id):
+        """Get the buffer slot with an ID.
+
+        Arguments:
+            slot_id (int): The ID of the slot.
+
+        Returns:
+            Tuple[str, str, Any]: The buffer, attribute, and value.
+        """
+        return self.slots[slot_id]
+
+
+def _copy_multimap(multimap):
+    result = TreeMultiMap()
+    for key, value in multimap.items():
+        result.add(key, value)
+    return result
+
+
 class KnowledgeStore:
     """Generic interface to a knowledge base."""
 
@@ -314,6 +598,51 @@ class KnowledgeStore:
         """
         raise NotImplementedError()
 
+    def iter_query(self, attr_vals, limit=None):
+        """Yield every element with the given attributes.
+
+        Unlike query(), this neither moves the result cursor nor activates the
+        elements, and elements are fetched as they are needed.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+            limit (int): The maximum number of elements. Defaults to None, for all elements.
+
+        Yields:
+            TreeMultiMap: The matching elements.
+        """
+        raise NotImplementedError()
+
+    def partial_query(self, attr_vals, k=10, activation_weight=0.0, mismatch_penalty=1.0):
+        """Search the KB for the elements that best match the given attributes.
+
+        Elements are scored by the ACT-R partial matching equation, where each
+        attribute-value pair of the query that the element does not have is
+        penalized, plus optionally the activation of the element. The best
+        elements are then available through the usual result cursor.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+            k (int): The maximum number of results. Defaults to 10; None means all.
+            activation_weight (float): The weight of activation in the score. Defaults to 0.
+            mismatch_penalty (float): The penalty for each mismatched attribute. Defaults to 1.
+
+        Returns:
+            TreeMultiMap: The best search result, or None.
+        """
+        raise NotImplementedError()
+
+    def explain(self, attr_vals):
+        """Describe how a query would be evaluated, without changing any state.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+
+        Returns:
+            List[QueryStage]: The stages of the query, in the order they are run.
+        """
+        raise NotImplementedError()
+
     @property
     def has_prev_result(self):
         """Determine if a previous query result is available.
@@ -360,195 +689,1815 @@ class KnowledgeStore:
         """
         raise NotImplementedError()
 
+    def get_cursor(self):
+        """Get the state of the result cursor.
 
-class NaiveDictKB(KnowledgeStore):
-    """A list-of-dictionary implementation of a knowledge store."""
+        Returns:
+            any: An opaque cursor to pass to set_cursor().
+        """
+        raise NotImplementedError()
 
-    def __init__(self):
-        """Initialize the NaiveDictKB."""
-        self.knowledge = []
-        self.query_index = None
-        self.query_matches = []
+    def set_cursor(self, cursor):
+        """Replace the state of the result cursor.
 
-    def clear(self): # noqa: D102
-        self.knowledge = []
-        self.query_index = None
-        self.query_matches = []
+        Results of the cursor that were removed from the KB since the cursor
+        was saved are skipped.
 
-    def store(self, mem_id=None, **kwargs): # noqa: D102
-        self.knowledge.append(TreeMultiMap(**kwargs))
-        return True
+        Arguments:
+            cursor (any): A cursor from this KB, or None for no current query.
+        """
+        raise NotImplementedError()
 
-    def retrieve(self, mem_id): # noqa: D102
+    def snapshot(self):
+        """Capture the activation and cursor state of the KB.
+
+        Knowledge stored after the snapshot is not removed by restoring it.
+
+        Returns:
+            any: An opaque snapshot to pass to restore().
+        """
         raise NotImplementedError()
 
-    def query(self, attr_vals): # noqa: D102
-        candidates = []
-        for candidate in self.knowledge:
-            match = all(
-                attr in candidate and candidate[attr] == val
-                for attr, val in attr_vals.items()
-            )
-            if match:
-                candidates.append(candidate)
-        if candidates:
-            # if the current retrieved item still matches the new query
-            # leave it there but update the cached matches and index
-            if self.query_index is not None:
-                curr_retrieved = self.query_matches[self.query_index]
-            else:
-                curr_retrieved = None
-            self.query_matches = sorted(candidates)
-            # use the ValueError from list.index() to determine if the query still matches
-            try:
-                self.query_index = self.query_matches.index(curr_retrieved)
-            except ValueError:
-                self.query_index = 0
-            return self.query_matches[self.query_index]
-        self.query_index = None
-        self.query_matches = []
-        return None
+    def restore(self, snapshot):
+        """Return the activation and cursor state of the KB to a snapshot.
 
-    @property
-    def has_prev_result(self): # noqa: D102
-        return True
+        Arguments:
+            snapshot (any): A snapshot from this KB.
+        """
+        raise NotImplementedError()
 
-    def prev_result(self): # noqa: D102
-        self.query_index = (self.query_index - 1) % len(self.query_matches)
-        return self.query_matches[self.query_index]
+    def fork(self):
+        """Create an independent copy of the KB.
 
-    @property
-    def has_next_result(self): # noqa: D102
-        return True
+        Returns:
+            KnowledgeStore: The copy.
+        """
+        return deepcopy(self)
 
-    def next_result(self): # noqa: D102
-        self.query_index = (self.query_index + 1) % len(self.query_matches)
-        return self.query_matches[self.query_index]
 
-    @staticmethod
-    def retrievable(mem_id): # noqa: D102
-        return False
+QueryStage = namedtuple('QueryStage', 'operation, term, estimated, actual, seconds')
+MatchSet = namedtuple('MatchSet', 'terms, generation, versions, mem_ids, derived')
+ActivationRecord = namedtuple('ActivationRecord', 'count, entries')
 
 
-class NetworkXKB(KnowledgeStore):
-    """A NetworkX implementation of a knowledge store."""
+class _Deleted:
+    """The marker for a key deleted in a layer of an OverlayMap."""
 
-    def __init__(self, activation_fn=None):
-        """Initialize the NetworkXKB."""
-        # parameters
-        if activation_fn is None:
-            activation_fn = (lambda graph, mem_id: None)
-        self.activation_fn = activation_fn
-        # variables
-        self.graph = MultiDiGraph()
-        self.inverted_index = defaultdict(set)
-        self.query_results = None
-        self.result_index = None
-        self.time = 0
-        self.decay_rate = 0.5
-        self.clear()
+    def __reduce__(self):
+        # copies and unpickled maps must use the same marker
+        return '_DELETED'
 
-    def getTime(self):
-        return self.time
-    def getDecayRate(self):
-        return self.decay_rate
 
-    # no [(3,0.5), (3, 1)], keep the higher one since it can't go any higher or lower
-    # sum from i to current time = (how long ago the event was) ^ -d(d changes depending on how fast the decay is)
-    # ^^ sorta have?
+_DELETED = _Deleted()
 
-    def update_neighbors(self, currNode, currentActivation, currentTime):
-        currNeighbors = self.graph.neighbors(currNode)
-        newActivation = round((currentActivation/2), 2)
-        for node in currNeighbors:
-            if node != currNode and newActivation > 0:
-                self.activation_fn(self.graph, node, [self.getTime(), newActivation])
-                self.update_neighbors(node, newActivation, currentTime)
 
-    def getActivation(self, nodeActivation, timePassed, decayRate):
-        decayAmount = round(pow(timePassed, decayRate * -1), 2)
-        newActivation = nodeActivation - decayAmount
-        return newActivation
+class OverlayMap:
+    """A mapping that shares its contents with its snapshots and forks.
 
-    def decay(self):
-        node_iterator = self.graph.__iter__()
-        for node in node_iterator:
-            currNode = self.graph.nodes.get(node)
-            size = len(self.graph.nodes.get(node)['activation'])
-            for i in range(size):
-                currActivation = currNode['activation'][i][1]
-                currNode['activation'][i][1] = self.getActivation(currActivation, self.getTime(), self.getDecayRate())
-        return
+    The contents are a stack of frozen layers, newest first, under a local
+    layer that receives all changes. Freezing the local layer captures the
+    current contents without copying them, and a fork or a restored snapshot
+    starts a new local layer over the frozen ones, so the cost of both only
+    depends on the number of changes. A frozen layer is merged into the one
+    below it once it is as large, which keeps the number of layers
+    logarithmic in the number of changes.
+    """
 
+    def __init__(self, layers=()):
+        """Initialize the OverlayMap.
 
-    def clear(self): # noqa: D102
-        self.graph.clear()
-        self.inverted_index.clear()
-        self.query_results = None
-        self.result_index = None
+        Arguments:
+            layers (Tuple[Dict, ...]): Frozen layers from freeze(). Defaults to empty.
+        """
+        self.layers = layers
+        self.local = {}
 
-    def store(self, mem_id=None, **kwargs): # noqa: D102
-        if mem_id is None:
-            mem_id = uuid()
-        if mem_id not in self.graph:
-            self.graph.add_node(mem_id, activation=[[self.getTime(), 1]])
+    def _lookup(self, key):
+        if key in self.local:
+            return self.local[key]
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+        return _DELETED
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _DELETED
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _DELETED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        """Get the value of a key.
+
+        Arguments:
+            key (Hashable): The key.
+            default (Any): The value if the key is missing. Defaults to None.
+
+        Returns:
+            Any: The value of the key.
+        """
+        value = self._lookup(key)
+        if value is _DELETED:
+            return default
+        return value
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self.layers:
+            self.local[key] = _DELETED
         else:
-            self.activation_fn(self.graph, mem_id, [self.getTime(), 1])
-        for attribute, value in kwargs.items():
-            if value not in self.graph:
-                self.graph.add_node(value, activation=[])
-            self.graph.add_edge(mem_id, value, attribute=attribute)
-            self.inverted_index[attribute].add(mem_id)
-        self.update_neighbors(mem_id, 1, self.getTime())
-        self.pass_time()
-        return True
+            del self.local[key]
 
-    def _activate_and_return(self, mem_id, activation):
-        self.activation_fn(self.graph, mem_id, activation)
-        result = TreeMultiMap()
-        for _, value, data in self.graph.out_edges(mem_id, data=True):
-            result.add(data['attribute'], value)
-        return result
+    def items(self):
+        """Yield the keys and values.
 
-    def retrieve(self, mem_id): # noqa: D102
-        if mem_id not in self.graph:
-            return None
-        self.pass_time()
-        self.update_neighbors(mem_id, 1, self.getTime())
-        return self._activate_and_return(mem_id, [self.getTime(), 1])
+        Yields:
+            Tuple[Hashable, Any]: A key and its value.
+        """
+        seen = set()
+        for layer in (self.local, *self.layers):
+            for key, value in layer.items():
+                if key not in seen:
+                    seen.add(key)
+                    if value is not _DELETED:
+                        yield key, value
 
-    def query(self, attr_vals): # noqa: D102
-        # first pass: get candidates with all the attributes
-        candidates = set.intersection(*(
-            self.inverted_index[attribute] for attribute in attr_vals.keys()
-        ))
-        # second pass: get candidates with the correct values
-        candidates = set(
-            candidate for candidate in candidates
-            if all((
-                (candidate, value) in self.graph.edges
-                and self.graph.get_edge_data(candidate, value)[0]['attribute'] == attribute
-            ) for attribute, value in attr_vals.items())
-        )
-        # quit early if there are no results
-        if not candidates:
-            self.query_results = None
-            self.result_index = None
-            return None
-        # final pass: sort results by activation
-        self.query_results = sorted(
-            candidates,
-            key=(lambda mem_id: self.graph.nodes[mem_id]['activation']),
-            reverse=True,
-        )
-        self.result_index = 0
-        self.pass_time()
-        node = self.query_results[self.result_index]
-        return self._activate_and_return(node, [self.getTime(), 1])
+    def __iter__(self):
+        return (key for key, _ in self.items())
 
-    def pass_time(self, time=1):
-        self.time += time
-        self.decay()
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def freeze(self):
+        """Make the current contents immutable, so they can be shared.
+
+        Returns:
+            Tuple[Dict, ...]: The frozen layers, to create an OverlayMap with the current contents.
+        """
+        if self.local:
+            layers = (self.local, *self.layers)
+            self.local = {}
+            while len(layers) > 1 and len(layers[0]) >= len(layers[1]):
+                merged = dict(layers[1])
+                merged.update(layers[0])
+                if len(layers) == 2:
+                    merged = {key: value for key, value in merged.items() if value is not _DELETED}
+                layers = (merged, *layers[2:])
+            self.layers = layers
+        return self.layers
+
+    def fork(self):
+        """Create a copy that shares the current contents.
+
+        Returns:
+            OverlayMap: The copy.
+        """
+        return OverlayMap(self.freeze())
+
+    def changed(self, layers):
+        """Find the keys whose values may differ from some frozen contents.
+
+        Arguments:
+            layers (Tuple[Dict, ...]): Frozen layers from freeze().
+
+        Returns:
+            Set[Hashable]: The keys that may have changed, which is all keys
+                outside the layers shared with the frozen contents.
+        """
+        i, j = len(self.layers), len(layers)
+        while i and j and self.layers[i - 1] is layers[j - 1]:
+            i -= 1
+            j -= 1
+        keys = set(self.local)
+        for layer in (*self.layers[:i], *layers[:j]):
+            keys.update(layer)
+        return keys
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class AttributeIndex:
+    """An inverted index from attribute-value pairs to memory elements.
+
+    Besides the postings themselves, the index keeps the number of elements
+    with each attribute, which together with the posting sizes is used to
+    evaluate conjunctive queries starting from the most selective term. Every
+    posting also records the generation in which it last changed, so that the
+    matches of an earlier query can be reused while its postings are intact,
+    whether it was the last query or one in the memo of recent queries.
+
+    Values that cannot be hashed, such as lists, have no postings. They are
+    kept by attribute instead, and matched by scanning the elements that have
+    that attribute; queries with such values are not memoized.
+    """
+
+    def __init__(self, memo_size=128):
+        """Initialize the AttributeIndex.
+
+        Arguments:
+            memo_size (int): The number of recent matches to remember. Defaults to 128.
+        """
+        # parameters
+        self.memo_size = memo_size
+        # variables
+        self.postings = defaultdict(set) # (attribute, value) -> mem_ids
+        self.unhashable = {} # attribute -> mem_id -> values
+        self.attributes = defaultdict(Counter) # attribute -> mem_id -> num_values
+        self.num_terms = Counter() # mem_id -> num_postings
+        self.versions = Counter() # (attribute, value) -> generation
+        self.generation = 0
+        self.cleared = 0
+        self.memo = OrderedDict() # terms -> MatchSet
+        self.memo_stats = Counter()
+
+    def __len__(self):
+        return len(self.num_terms)
+
+    def clear(self):
+        """Remove all postings."""
+        self.postings.clear()
+        self.unhashable.clear()
+        self.attributes.clear()
+        self.num_terms.clear()
+        self.versions.clear()
+        self.generation += 1
+        self.cleared = self.generation
+        self.memo.clear()
+
+    def _bump(self, term):
+        self.generation += 1
+        self.versions[term] = self.generation
+
+    def add(self, mem_id, attribute, value):
+        """Index an attribute-value pair of an element.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+            attribute (str): The attribute.
+            value (any): The value.
+        """
+        if _hashable(value):
+            posting = self.postings[(attribute, value)]
+            if mem_id in posting:
+                return
+            posting.add(mem_id)
+            self._bump((attribute, value))
+        else:
+            values = self.unhashable.setdefault(attribute, {}).setdefault(mem_id, [])
+            if value in values:
+                return
+            values.append(value)
+        self.attributes[attribute][mem_id] += 1
+        self.num_terms[mem_id] += 1
+
+    def discard(self, mem_id, attribute, value):
+        """Remove an attribute-value pair of an element from the index.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+            attribute (str): The attribute.
+            value (any): The value.
+        """
+        if _hashable(value):
+            posting = self.postings.get((attribute, value))
+            if posting is None or mem_id not in posting:
+                return
+            posting.remove(mem_id)
+            self._bump((attribute, value))
+            if not posting:
+                del self.postings[(attribute, value)]
+        else:
+            elements = self.unhashable.get(attribute, {})
+            values = elements.get(mem_id, [])
+            if value not in values:
+                return
+            values.remove(value)
+            if not values:
+                del elements[mem_id]
+                if not elements:
+                    del self.unhashable[attribute]
+        self.attributes[attribute][mem_id] -= 1
+        if self.attributes[attribute][mem_id] == 0:
+            del self.attributes[attribute][mem_id]
+            if not self.attributes[attribute]:
+                del self.attributes[attribute]
+        self.num_terms[mem_id] -= 1
+        if self.num_terms[mem_id] == 0:
+            del self.num_terms[mem_id]
+
+    def posting(self, term):
+        """Find the elements that have an attribute-value pair.
+
+        Arguments:
+            term (Tuple[str, Any]): The attribute-value pair.
+
+        Returns:
+            Set[any]: The IDs of the elements, which must not be modified.
+        """
+        attribute, value = term
+        if _hashable(value):
+            return self.postings.get(term, ())
+        return set(
+            mem_id for mem_id, values in self.unhashable.get(attribute, {}).items()
+            if value in values
+        )
+
+    def cardinality(self, attribute, value=None):
+        """Count the elements with an attribute or an attribute-value pair.
+
+        Arguments:
+            attribute (str): The attribute.
+            value (any): The value. Defaults to None, which counts all values.
+
+        Returns:
+            int: The number of elements.
+        """
+        if value is None:
+            return len(self.attributes.get(attribute, ()))
+        return len(self.posting((attribute, value)))
+
+    def plan(self, attr_vals):
+        """Order the terms of a conjunctive query from most to least selective.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+
+        Returns:
+            List[Tuple[str, Any]]: The attribute-value pairs in evaluation order.
+        """
+        return sorted(
+            attr_vals.items(),
+            key=(lambda term: (len(self.posting(term)), self.cardinality(term[0]))),
+        )
+
+    def match(self, attr_vals):
+        """Find the elements that have all the given attribute-value pairs.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+
+        Returns:
+            Set[any]: The IDs of the matching elements.
+        """
+        return set(self.iter_match(attr_vals))
+
+    def iter_match(self, attr_vals):
+        """Yield the elements that have all the given attribute-value pairs.
+
+        The postings must not change while the elements are being yielded.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+
+        Yields:
+            any: The IDs of the matching elements.
+        """
+        if not attr_vals:
+            return
+        first, *rest = self.plan(attr_vals)
+        filters = [self.posting(term) for term in rest]
+        for mem_id in self.posting(first):
+            if all(mem_id in posting for posting in filters):
+                yield mem_id
+
+    def is_current(self, match_set):
+        """Determine if the postings of an earlier match are unchanged.
+
+        Arguments:
+            match_set (MatchSet): The earlier match.
+
+        Returns:
+            bool: True if the matching elements would still be the same.
+        """
+        return (
+            match_set.generation >= self.cleared
+            and all(self.versions[term] == version for term, version in match_set.versions)
+        )
+
+    def match_set(self, attr_vals, previous=None):
+        """Match a query, reusing the matches of a similar earlier query.
+
+        If the same query is in the memo and its postings have not changed,
+        the memoized matches are returned. If the query only adds terms to the
+        earlier query, the earlier matches are filtered by the new terms.
+        Otherwise, including when terms were removed, the matches are widened
+        by evaluating the remaining terms against their postings.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+            previous (MatchSet): The matches of an earlier query. Defaults to None.
+
+        Returns:
+            MatchSet: The matches of the query. The set of IDs must not be modified,
+                but callers may cache what they compute from it in its derived dict.
+        """
+        if not all(_hashable(value) for value in attr_vals.values()):
+            self.memo_stats['misses'] += 1
+            return MatchSet(None, self.generation, (), self.match(attr_vals), {})
+        if previous is not None and previous.terms is None:
+            previous = None
+        terms = frozenset(attr_vals.items())
+        if previous is not None and previous.terms == terms and self.is_current(previous):
+            self.memo_stats['hits'] += 1
+            return previous
+        memoized = self.memo.get(terms)
+        if memoized is not None:
+            if self.is_current(memoized):
+                self.memo.move_to_end(terms)
+                self.memo_stats['hits'] += 1
+                return memoized
+            del self.memo[terms]
+        self.memo_stats['misses'] += 1
+        if previous is not None and previous.terms < terms and self.is_current(previous):
+            filters = sorted(
+                (self.postings.get(term, ()) for term in terms - previous.terms),
+                key=len,
+            )
+            mem_ids = set(
+                mem_id for mem_id in previous.mem_ids
+                if all(mem_id in posting for posting in filters)
+            )
+        else:
+            mem_ids = self.match(attr_vals)
+        match_set = MatchSet(
+            terms,
+            self.generation,
+            tuple((term, self.versions[term]) for term in terms),
+            mem_ids,
+            {},
+        )
+        if self.memo_size:
+            self.memo[terms] = match_set
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return match_set
+
+    def memo_report(self):
+        """Summarize the use of the memo.
+
+        Returns:
+            Dict[str, float]: The memo statistics.
+        """
+        lookups = self.memo_stats['hits'] + self.memo_stats['misses']
+        return {
+            'size': len(self.memo),
+            'max_size': self.memo_size,
+            'hits': self.memo_stats['hits'],
+            'misses': self.memo_stats['misses'],
+            'hit_rate': (self.memo_stats['hits'] / lookups if lookups else None),
+        }
+
+    def explain(self, attr_vals):
+        """Evaluate a query stage by stage, recording the sizes and times.
+
+        The estimated number of candidates after each filter assumes that the
+        terms are independent.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+
+        Returns:
+            List[QueryStage]: The scan and filter stages, in evaluation order.
+        """
+        stages = []
+        candidates = None
+        estimate = None
+        for term in self.plan(attr_vals):
+            start = perf_counter()
+            posting = self.posting(term)
+            if candidates is None:
+                operation = 'scan'
+                estimate = len(posting)
+                candidates = set(posting)
+            else:
+                operation = 'filter'
+                estimate = estimate * len(posting) / max(len(self), 1)
+                candidates = set(mem_id for mem_id in candidates if mem_id in posting)
+            stages.append(QueryStage(
+                operation, term, estimate, len(candidates), perf_counter() - start,
+            ))
+        return stages
+
+
+class FeatureMatrix:
+    """A sparse matrix of memory elements by attribute-value pairs.
+
+    Each interned attribute-value pair is a column, stored as an array of the
+    rows that have it, so that scoring a query against every element only
+    loops over the terms of the query. Pairs with values that cannot be
+    hashed are not interned, so they never count as matches. Rows of removed elements are masked out
+    until enough of them accumulate to be worth compacting.
+    """
+
+    def __init__(self):
+        """Initialize the FeatureMatrix."""
+        self.columns = {} # (attribute, value) -> column
+        self.column_rows = [] # column -> array of rows, with spare capacity
+        self.column_sizes = [] # column -> number of rows
+        self.rows = {} # mem_id -> row
+        self.mem_ids = [] # row -> mem_id
+        self.alive = np.zeros(0, dtype=bool)
+        self.counts = np.zeros(0)
+        self.created = np.zeros(0)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, mem_id):
+        return mem_id in self.rows
+
+    def add(self, mem_id, attr_vals, time, num_activations=1):
+        """Add an element, or add attribute-value pairs to an existing element.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+            attr_vals (Iterable[Tuple[str, Any]]): The attribute-value pairs.
+            time (float): The current time.
+            num_activations (int): The number of previous activations. Defaults to 1.
+        """
+        row = self.rows.get(mem_id)
+        if row is None:
+            row = len(self.mem_ids)
+            if row == len(self.alive):
+                size = max(16, 2 * row)
+                self.alive = np.resize(self.alive, size)
+                self.counts = np.resize(self.counts, size)
+                self.created = np.resize(self.created, size)
+            self.rows[mem_id] = row
+            self.mem_ids.append(mem_id)
+            self.alive[row] = True
+            self.counts[row] = num_activations
+            self.created[row] = time
+        for term in attr_vals:
+            if not _hashable(term):
+                continue
+            column = self.columns.get(term)
+            if column is None:
+                column = len(self.column_rows)
+                self.columns[term] = column
+                self.column_rows.append(np.zeros(4, dtype=np.int64))
+                self.column_sizes.append(0)
+            size = self.column_sizes[column]
+            if size == len(self.column_rows[column]):
+                self.column_rows[column] = np.resize(self.column_rows[column], 2 * size)
+            self.column_rows[column][size] = row
+            self.column_sizes[column] = size + 1
+
+    def remove(self, mem_id):
+        """Remove an element.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+        """
+        row = self.rows.pop(mem_id, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        self.mem_ids[row] = None
+        if len(self.mem_ids) - len(self.rows) > max(1024, len(self.rows)):
+            self._compact()
+
+    def _compact(self):
+        num_rows = len(self.mem_ids)
+        alive = self.alive[:num_rows]
+        renumbered = np.cumsum(alive) - 1
+        for column, size in enumerate(self.column_sizes):
+            rows = self.column_rows[column][:size]
+            rows = renumbered[rows[alive[rows]]]
+            self.column_rows[column] = np.resize(rows, max(4, len(rows)))
+            self.column_sizes[column] = len(rows)
+        self.mem_ids = [mem_id for mem_id in self.mem_ids if mem_id in self.rows]
+        self.rows = {mem_id: row for row, mem_id in enumerate(self.mem_ids)}
+        self.counts = self.counts[:num_rows][alive]
+        self.created = self.created[:num_rows][alive]
+        self.alive = np.ones(len(self.mem_ids), dtype=bool)
+
+    def touch(self, mem_id, num_activations=None):
+        """Record an activation of an element, or set its number of activations.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+            num_activations (int): The number of activations. Defaults to None,
+                which adds one activation.
+        """
+        row = self.rows.get(mem_id)
+        if row is None:
+            return
+        if num_activations is None:
+            self.counts[row] += 1
+        else:
+            self.counts[row] = num_activations
+
+    def activations(self, time, decay):
+        """Approximate the base-level activation of every element.
+
+        This uses the ACT-R optimized learning equation, which only needs the
+        number of activations and the time since the element was created.
+
+        Arguments:
+            time (float): The current time.
+            decay (float): The decay rate, which must be less than 1.
+
+        Returns:
+            numpy.ndarray: The activation of each row.
+        """
+        num_rows = len(self.mem_ids)
+        lifetimes = np.maximum(time - self.created[:num_rows], 1)
+        return np.log(self.counts[:num_rows] / (1 - decay)) - decay * np.log(lifetimes)
+
+    def rank(self, attr_vals, k=None, activation_weight=0.0, mismatch_penalty=1.0, time=0, decay=0.5):
+        """Rank the elements that share at least one attribute-value pair with a query.
+
+        Arguments:
+            attr_vals (Mapping[str, Any]): Attributes and values of the desired element.
+            k (int): The maximum number of results. Defaults to None, for all results.
+            activation_weight (float): The weight of activation in the score. Defaults to 0.
+            mismatch_penalty (float): The penalty for each mismatched attribute. Defaults to 1.
+            time (float): The current time, for activation. Defaults to 0.
+            decay (float): The decay rate, for activation. Defaults to 0.5.
+
+        Returns:
+            List[any]: The IDs of the best elements, best first.
+        """
+        num_rows = len(self.mem_ids)
+        matches = np.zeros(num_rows)
+        for term in attr_vals.items():
+            column = self.columns.get(term) if _hashable(term) else None
+            if column is not None:
+                matches[self.column_rows[column][:self.column_sizes[column]]] += 1
+        rows = np.flatnonzero(self.alive[:num_rows] & (matches > 0))
+        scores = mismatch_penalty * (matches[rows] - len(attr_vals))
+        if activation_weight:
+            scores += activation_weight * self.activations(time, decay)[rows]
+        if k is not None and k < len(rows):
+            best = np.argpartition(-scores, k - 1)[:k]
+            rows = rows[best]
+            scores = scores[best]
+        rows = rows[np.argsort(-scores, kind='stable')]
+        return [self.mem_ids[row] for row in rows]
+
+
+class MemoryBudget:
+    """A capacity limit on the number or size of memory elements.
+
+    Elements are kept in a heap keyed on their activation priority. Updating a
+    priority pushes a new heap entry and leaves the old one to be skipped when
+    it surfaces, so neither touching an element nor finding the next element to
+    evict requires a scan of the whole store.
+    """
+
+    def __init__(self, max_elements=None, max_bytes=None):
+        """Initialize the MemoryBudget.
+
+        Arguments:
+            max_elements (int): The maximum number of elements. Defaults to None.
+            max_bytes (int): The maximum approximate size of all elements. Defaults to None.
+        """
+        # parameters
+        self.max_elements = max_elements
+        self.max_bytes = max_bytes
+        # variables
+        self.entries = {} # mem_id -> (priority, serial, num_bytes)
+        self.heap = []
+        self.serials = count()
+        self.num_bytes = 0
+        self.stats = defaultdict(int)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, mem_id):
+        return mem_id in self.entries
+
+    @property
+    def bounded(self):
+        """Determine if there is any limit to enforce.
+
+        Returns:
+            bool: True if either limit is set.
+        """
+        return self.max_elements is not None or self.max_bytes is not None
+
+    @property
+    def exceeded(self):
+        """Determine if the elements are over budget.
+
+        Returns:
+            bool: True if some element must be evicted.
+        """
+        return (
+            (self.max_elements is not None and len(self.entries) > self.max_elements)
+            or (self.max_bytes is not None and self.num_bytes > self.max_bytes)
+        )
+
+    def clear(self):
+        """Forget all elements, but keep the eviction statistics."""
+        self.entries = {}
+        self.heap = []
+        self.num_bytes = 0
+
+    def touch(self, mem_id, priority, num_bytes=None):
+        """Add an element or update its priority and size.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+            priority (any): The new priority; lower priorities are evicted first.
+            num_bytes (int): The new approximate size. Defaults to the previous size.
+        """
+        old_bytes = 0
+        if mem_id in self.entries:
+            old_bytes = self.entries[mem_id][2]
+        if num_bytes is None:
+            num_bytes = old_bytes
+        self.num_bytes += num_bytes - old_bytes
+        serial = next(self.serials)
+        self.entries[mem_id] = (priority, serial, num_bytes)
+        heappush(self.heap, (priority, serial, mem_id))
+        # drop stale entries once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [
+                (priority, serial, mem_id)
+                for mem_id, (priority, serial, _) in self.entries.items()
+            ]
+            heapify(self.heap)
+
+    def discard(self, mem_id):
+        """Stop tracking an element.
+
+        Arguments:
+            mem_id (any): The ID of the element.
+        """
+        entry = self.entries.pop(mem_id, None)
+        if entry is not None:
+            self.num_bytes -= entry[2]
+
+    def victims(self, keep=None):
+        """Yield the lowest-priority elements until the budget is met.
+
+        Each yielded element is no longer tracked; the caller is responsible
+        for actually removing it from the store.
+
+        Arguments:
+            keep (any): An element that should not be evicted. Defaults to None.
+
+        Yields:
+            any: The ID of the element to evict.
+        """
+        kept = None
+        while self.heap and self.exceeded:
+            priority, serial, mem_id = heappop(self.heap)
+            entry = self.entries.get(mem_id)
+            if entry is None or entry[1] != serial:
+                continue
+            if keep is not None and mem_id == keep:
+                kept = (priority, serial, mem_id)
+                continue
+            self.discard(mem_id)
+            self.stats['evicted_elements'] += 1
+            self.stats['evicted_bytes'] += entry[2]
+            yield mem_id
+        if kept is not None:
+            heappush(self.heap, kept)
+
+    def report(self):
+        """Summarize the current usage and the evictions so far.
+
+        Returns:
+            Dict[str, int]: The eviction statistics.
+        """
+        return {
+            'elements': len(self.entries),
+            'bytes': self.num_bytes,
+            'max_elements': self.max_elements,
+            'max_bytes': self.max_bytes,
+            'evicted_elements': self.stats['evicted_elements'],
+            'evicted_bytes': self.stats['evicted_bytes'],
+            'evicted_values': self.stats['evicted_values'],
+        }
+
+
+class _LocalKnowledgeStore(KnowledgeStore):
+    """The parts of a knowledge store that keeps its elements in memory.
+
+    Subclasses keep an AttributeIndex as inverted_index, a MemoryBudget as
+    budget, an optional FeatureMatrix as features, and the activations of
+    their elements in an OverlayMap as activations. The parts listed in
+    STRUCTURE are shared with forks until a store modifies them, and the
+    budget and the feature matrix are only updated with new activations when
+    they are next needed, so that forks that only retrieve elements do not
+    need their own copies.
+    """
+
+    STRUCTURE = ()
+
+    def _writable(self, *names):
+        # copy the parts of the structure shared with a fork before modifying them
+        for name in names:
+            if name in self.shared:
+                setattr(self, name, self._copy_structure(name))
+                self.shared.discard(name)
+
+    def _copy_structure(self, name):
+        return deepcopy(getattr(self, name))
+
+    def _share_structure(self, forked):
+        self.shared = set(self.STRUCTURE)
+        forked.shared = set(self.STRUCTURE)
+
+    def _is_stored(self, mem_id):
+        raise NotImplementedError()
+
+    def _eviction_priority(self, mem_id):
+        raise NotImplementedError()
+
+    def _num_activations(self, mem_id):
+        raise NotImplementedError()
+
+    def _live_results(self, results, index, num_removals):
+        # drop the results of a saved cursor that were removed since it was
+        # saved, moving the index as evicting them one at a time would
+        if num_removals == self.num_removals or not results:
+            return results, index
+        live = []
+        live_index = 0
+        for i, mem_id in enumerate(results):
+            if i == index:
+                live_index = len(live)
+            if self._is_stored(mem_id):
+                live.append(mem_id)
+        if len(live) == len(results):
+            return results, index
+        if not live:
+            return live, None
+        return live, min(live_index, len(live) - 1)
+
+    def _sync_activations(self):
+        # update the budget and the feature matrix with the activations that
+        # changed since they were last updated
+        if not self.budget.bounded and self.features is None:
+            return
+        changed = self.activations.changed(self.synced_activations)
+        if changed:
+            self._writable('budget', 'features')
+        for mem_id in changed:
+            if mem_id not in self.activations:
+                continue
+            if mem_id in self.budget:
+                self.budget.touch(mem_id, self._eviction_priority(mem_id))
+            if self.features is not None:
+                self.features.touch(mem_id, self._num_activations(mem_id))
+        self.synced_activations = self.activations.freeze()
+
+    @property
+    def eviction_stats(self):
+        """Summarize the memory usage and evictions of this store.
+
+        Returns:
+            Dict[str, int]: The eviction statistics.
+        """
+        return self.budget.report()
+
+    @property
+    def memo_stats(self):
+        """Summarize the use of the query memo.
+
+        Returns:
+            Dict[str, float]: The memo statistics.
+        """
+        return self.inverted_index.memo_report()
+
+
+class NaiveDictKB(_LocalKnowledgeStore):
+    """A list-of-dictionary implementation of a knowledge store.
+
+    The elements and the record of when they were last retrieved are kept in
+    OverlayMaps, so forks share them and only keep their own changes. The
+    index, the memory budget, and the feature matrix are shared until a fork
+    stores or evicts an element, at which point that fork copies them.
+    """
+
+    STRUCTURE = ('inverted_index', 'budget', 'features')
+
+    def __init__(self, max_elements=None, max_bytes=None, memo_size=128):
+        """Initialize the NaiveDictKB.
+
+        Arguments:
+            max_elements (int): The maximum number of elements to keep. Defaults to None.
+            max_bytes (int): The maximum approximate size of all elements. Defaults to None.
+            memo_size (int): The number of recent query matches to remember. Defaults to 128.
+        """
+        self.knowledge = OverlayMap()
+        self.inverted_index = AttributeIndex(memo_size)
+        self.element_ids = count()
+        self.query_index = None
+        self.query_matches = []
+        self.prev_match = None
+        self.budget = MemoryBudget(max_elements, max_bytes)
+        self.features = None
+        self.time = 0
+        self.activations = OverlayMap() # element_id -> (time, num_touches)
+        self.synced_activations = ()
+        self.shared = set()
+        self.num_removals = 0
+
+    def clear(self): # noqa: D102
+        self._writable('inverted_index', 'budget')
+        self.knowledge = OverlayMap()
+        self.inverted_index.clear()
+        self.num_removals += 1
+        self.query_index = None
+        self.query_matches = []
+        self.prev_match = None
+        self.budget.clear()
+        self.features = None
+        self.activations = OverlayMap()
+        self.synced_activations = ()
+
+    def store(self, mem_id=None, **kwargs): # noqa: D102
+        self._writable(*self.STRUCTURE)
+        element_id = next(self.element_ids)
+        self.knowledge[element_id] = TreeMultiMap(**kwargs)
+        for attr, val in kwargs.items():
+            self.inverted_index.add(element_id, attr, val)
+        if self.features is not None:
+            self.features.add(element_id, kwargs.items(), self.time)
+        if self.budget.bounded:
+            num_bytes = sum(getsizeof(attr) + getsizeof(val) for attr, val in kwargs.items())
+            self._touch(element_id)
+            self.budget.touch(element_id, self._eviction_priority(element_id), num_bytes)
+            self._sync_activations()
+            for victim in self.budget.victims(keep=element_id):
+                self._evict(victim)
+        return True
+
+    def _touch(self, element_id):
+        self.time += 1
+        _, num_touches = self.activations.get(element_id, (None, 0))
+        self.activations[element_id] = (self.time, num_touches + 1)
+
+    def _is_stored(self, mem_id):
+        return mem_id in self.knowledge
+
+    def _eviction_priority(self, mem_id):
+        # elements are evicted by the time they were last touched
+        return self.activations[mem_id][0]
+
+    def _num_activations(self, mem_id):
+        _, num_touches = self.activations.get(mem_id, (None, 0))
+        return num_touches + 1
+
+    def _evict(self, element_id):
+        for attr, val in self.knowledge[element_id].items():
+            self.inverted_index.discard(element_id, attr, val)
+        del self.knowledge[element_id]
+        self.num_removals += 1
+        if element_id in self.activations:
+            del self.activations[element_id]
+        if self.features is not None:
+            self.features.remove(element_id)
+        if element_id not in self.query_matches:
+            return
+        # replace rather than modify the matches, which snapshots may share
+        index = self.query_matches.index(element_id)
+        self.query_matches = self.query_matches[:index] + self.query_matches[index + 1:]
+        if not self.query_matches:
+            self.query_index = None
+        elif index < self.query_index or self.query_index == len(self.query_matches):
+            self.query_index -= 1
+
+    def _current_result(self):
+        element_id = self.query_matches[self.query_index]
+        self._touch(element_id)
+        return self.knowledge[element_id]
+
+    def retrieve(self, mem_id): # noqa: D102
+        raise NotImplementedError()
+
+    def _match(self, attr_vals):
+        if not attr_vals:
+            return set(self.knowledge)
+        return self.inverted_index.match(attr_vals)
+
+    def query(self, attr_vals): # noqa: D102
+        prev_match = self.prev_match
+        if attr_vals:
+            self.prev_match = self.inverted_index.match_set(attr_vals, prev_match)
+            candidates = self.prev_match.mem_ids
+        else:
+            self.prev_match = None
+            candidates = set(self.knowledge)
+        if candidates:
+            # if the current retrieved item still matches the new query
+            # leave it there but update the cached matches and index
+            if self.query_index is not None:
+                curr_retrieved = self.query_matches[self.query_index]
+            else:
+                curr_retrieved = None
+            # reuse the sorted matches if they were memoized, or if the query
+            # was narrowed, in which case the previous matches are already sorted
+            query_matches = []
+            if self.prev_match is not None:
+                query_matches = self.prev_match.derived.get('sorted', [])
+            if not query_matches and prev_match is not None:
+                query_matches = [
+                    element_id for element_id in self.query_matches
+                    if element_id in candidates
+                ]
+            if len(query_matches) != len(candidates):
+                query_matches = sorted(candidates, key=self.knowledge.__getitem__)
+            if self.prev_match is not None:
+                self.prev_match.derived['sorted'] = query_matches
+            self.query_matches = query_matches
+            # use the ValueError from list.index() to determine if the query still matches
+            try:
+                self.query_index = self.query_matches.index(curr_retrieved)
+            except ValueError:
+                self.query_index = 0
+            return self._current_result()
+        self.query_index = None
+        self.query_matches = []
+        return None
+
+    def iter_query(self, attr_vals, limit=None): # noqa: D102
+        # elements are yielded in index order, since sorting them would
+        # require holding all of them
+        if attr_vals:
+            element_ids = self.inverted_index.iter_match(attr_vals)
+        else:
+            element_ids = iter(self.knowledge)
+        for element_id in islice(element_ids, limit):
+            yield self.knowledge[element_id]
+
+    def partial_query(self, attr_vals, k=10, activation_weight=0.0, mismatch_penalty=1.0): # noqa: D102
+        self._sync_activations()
+        if self.features is None:
+            self.features = FeatureMatrix()
+            for element_id, element in self.knowledge.items():
+                self.features.add(element_id, element.items(), self.time, self._num_activations(element_id))
+            self.synced_activations = self.activations.freeze()
+            self.shared.discard('features')
+        self.prev_match = None
+        self.query_matches = self.features.rank(
+            attr_vals, k=k,
+            activation_weight=activation_weight, mismatch_penalty=mismatch_penalty,
+            time=self.time,
+        )
+        if not self.query_matches:
+            self.query_index = None
+            return None
+        self.query_index = 0
+        return self._current_result()
+
+    def explain(self, attr_vals): # noqa: D102
+        stages = self.inverted_index.explain(attr_vals)
+        candidates = self._match(attr_vals)
+        start = perf_counter()
+        sorted(candidates, key=self.knowledge.__getitem__)
+        stages.append(QueryStage('sort', None, len(candidates), len(candidates), perf_counter() - start))
+        return stages
+
+    @property
+    def has_prev_result(self): # noqa: D102
+        return True
+
+    def prev_result(self): # noqa: D102
+        self.query_index = (self.query_index - 1) % len(self.query_matches)
+        return self._current_result()
+
+    @property
+    def has_next_result(self): # noqa: D102
+        return True
+
+    def next_result(self): # noqa: D102
+        self.query_index = (self.query_index + 1) % len(self.query_matches)
+        return self._current_result()
+
+    @staticmethod
+    def retrievable(mem_id): # noqa: D102
+        return False
+
+    def get_cursor(self): # noqa: D102
+        return (self.query_matches, self.query_index, self.prev_match, self.num_removals)
+
+    def set_cursor(self, cursor): # noqa: D102
+        if cursor is None:
+            cursor = ([], None, None, self.num_removals)
+        query_matches, query_index, self.prev_match, num_removals = cursor
+        self.query_matches, self.query_index = self._live_results(query_matches, query_index, num_removals)
+
+    def snapshot(self): # noqa: D102
+        return (self.get_cursor(), self.time, self.activations.freeze())
+
+    def restore(self, snapshot): # noqa: D102
+        cursor, self.time, activations = snapshot
+        self.set_cursor(cursor)
+        restored = OverlayMap(activations)
+        # elements stored after the snapshot keep their touches, and elements
+        # evicted after it stay evicted
+        for element_id in self.activations.changed(activations):
+            if element_id not in self.knowledge:
+                if element_id in restored:
+                    del restored[element_id]
+            elif element_id in self.activations and element_id not in restored:
+                restored[element_id] = self.activations[element_id]
+        self.activations = restored
+
+    def fork(self): # noqa: D102
+        forked = copy(self)
+        forked.knowledge = self.knowledge.fork()
+        forked.activations = self.activations.fork()
+        self._share_structure(forked)
+        return forked
+
+
+class ElementView:
+    """A read-only view of an element in a NetworkXKB.
+
+    Looking up attributes and iterating over attributes and values reads the
+    graph directly, in the same order as a TreeMultiMap of the element, so
+    the memory architecture can generate actions and observations from a
+    view without copying it. Only comparisons, and looking up attributes with
+    several values, build a TreeMultiMap, which is then kept. The store materializes
+    a view before it changes the element's edges, so a view always shows the
+    element as it was when it was retrieved.
+    """
+
+    def __init__(self, graph, mem_id):
+        """Initialize the ElementView.
+
+        Arguments:
+            graph (networkx.MultiDiGraph): The graph of the store.
+            mem_id (Hashable): The ID of the element.
+        """
+        self.graph = graph
+        self.mem_id = mem_id
+        self.multimap = None
+
+    def materialize(self):
+        """Copy the element out of the graph, if not already done.
+
+        Returns:
+            TreeMultiMap: The element.
+        """
+        if self.multimap is None:
+            self.multimap = TreeMultiMap()
+            for _, value, data in self.graph.out_edges(self.mem_id, data=True):
+                self.multimap.add(data['attribute'], value)
+            self.graph = None
+        return self.multimap
+
+    def _pairs(self):
+        # sort by attribute only, keeping the values of an attribute in the
+        # order they were added, as a TreeMultiMap does
+        return sorted(
+            ((data['attribute'], value) for _, value, data in self.graph.out_edges(self.mem_id, data=True)),
+            key=(lambda pair: pair[0]),
+        )
+
+    def _values(self, attr):
+        return [
+            value for _, value, data in self.graph.out_edges(self.mem_id, data=True)
+            if data['attribute'] == attr
+        ]
+
+    def __getitem__(self, attr):
+        if self.multimap is None:
+            values = self._values(attr)
+            if len(values) == 1:
+                return values[0]
+            if not values:
+                raise KeyError(attr)
+        return self.materialize()[attr]
+
+    def get(self, attr, default=None):
+        """Get the value of an attribute.
+
+        Arguments:
+            attr (Any): The attribute.
+            default (Any): The value if the attribute is missing. Defaults to None.
+
+        Returns:
+            Any: The value of the attribute.
+        """
+        if attr in self:
+            return self[attr]
+        return default
+
+    def __contains__(self, attr):
+        if self.multimap is None:
+            return any(
+                data['attribute'] == attr
+                for _, _, data in self.graph.out_edges(self.mem_id, data=True)
+            )
+        return attr in self.multimap
+
+    def __bool__(self):
+        if self.multimap is None:
+            return self.graph.out_degree(self.mem_id) > 0
+        return bool(self.multimap)
+
+    def __len__(self):
+        if self.multimap is None:
+            return self.graph.out_degree(self.mem_id)
+        return len(self.multimap)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        """Get the attributes of the element.
+
+        Returns:
+            Iterable[Any]: The attributes.
+        """
+        if self.multimap is None:
+            return sorted(set(data['attribute'] for _, _, data in self.graph.out_edges(self.mem_id, data=True)))
+        return self.multimap.keys()
+
+    def values(self):
+        """Get the values of the element.
+
+        Returns:
+            Iterable[Any]: The values.
+        """
+        if self.multimap is None:
+            return [value for _, value in self._pairs()]
+        return self.multimap.values()
+
+    def items(self):
+        """Get the attributes and values of the element.
+
+        Returns:
+            Iterable[Tuple[Any, Any]]: The attributes and values.
+        """
+        if self.multimap is None:
+            return self._pairs()
+        return self.multimap.items()
+
+    def __eq__(self, other):
+        if isinstance(other, ElementView):
+            other = other.materialize()
+        return self.materialize() == other
+
+    def __lt__(self, other):
+        if isinstance(other, ElementView):
+            other = other.materialize()
+        return self.materialize() < other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # views are copied and pickled as plain multimaps
+        return (_copy_multimap, (self.materialize(),))
+
+    def __repr__(self):
+        return f'ElementView({self.mem_id!r}, {self.materialize()!r})'
+
+
+class _Descending:
+    """A heap entry that orders its key from largest to smallest."""
+
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+class _ActivationGraph:
+    """The graph of a NetworkXKB, with the activations of its nodes.
+
+    Everything but the data of the nodes is read from the graph of the store,
+    which must not be modified through this object. The data of each node
+    also has the list of its activations as "activation", with the decay so
+    far applied. Changes to these lists are written back to the store after
+    the activation function returns.
+    """
+
+    def __init__(self, store):
+        """Initialize the _ActivationGraph.
+
+        Arguments:
+            store (NetworkXKB): The store of the graph.
+        """
+        self.store = store
+        self.nodes = _ActivationNodes(self)
+        self.activations = {} # node -> (entries, originals)
+
+    def __getattr__(self, attr):
+        return getattr(self.store.multigraph, attr)
+
+    def __contains__(self, node):
+        return node in self.store.multigraph
+
+    def __iter__(self):
+        return iter(self.store.multigraph)
+
+    def __len__(self):
+        return len(self.store.multigraph)
+
+    def __getitem__(self, node):
+        return self.store.multigraph[node]
+
+    def activation(self, node):
+        """Get the list of activations of a node.
+
+        Arguments:
+            node (Hashable): The node.
+
+        Returns:
+            List[List[float]]: The time and the decayed value of each activation.
+        """
+        if node not in self.activations:
+            record = self.store.activations.get(node, ActivationRecord(0, ()))
+            entries = []
+            originals = {}
+            for time, value in record.entries:
+                entry = [time, value + self.store.decay_offset]
+                originals[id(entry)] = (entry, (time, entry[1]), value)
+                entries.append(entry)
+            self.activations[node] = (entries, originals)
+        return self.activations[node][0]
+
+    def set_activation(self, node, entries):
+        """Replace the list of activations of a node.
+
+        Arguments:
+            node (Hashable): The node.
+            entries (List[List[float]]): The time and the decayed value of each activation.
+        """
+        self.activation(node)
+        self.activations[node] = (entries, self.activations[node][1])
+
+    def stored_activations(self):
+        """Convert the lists of activations that were read back to stored values.
+
+        Only the values that were changed or added are converted, so that
+        unchanged values stay exact.
+
+        Yields:
+            Tuple[Hashable, Tuple[Tuple[float, float], ...]]: A node and its stored activations.
+        """
+        for node, (entries, originals) in self.activations.items():
+            stored = []
+            for entry in entries:
+                time, value = entry
+                original = originals.get(id(entry))
+                if original is not None and original[1] == (time, value):
+                    stored.append((time, original[2]))
+                else:
+                    stored.append((time, value - self.store.decay_offset))
+            yield node, tuple(stored)
+
+
+class _ActivationNodes(Mapping):
+    """The nodes of an _ActivationGraph, with their data."""
+
+    def __init__(self, graph):
+        """Initialize the _ActivationNodes.
+
+        Arguments:
+            graph (_ActivationGraph): The graph.
+        """
+        self.graph = graph
+
+    def __getitem__(self, node):
+        if node not in self.graph:
+            raise KeyError(node)
+        return _ActivationNodeData(self.graph, node)
+
+    def __iter__(self):
+        return iter(self.graph)
+
+    def __len__(self):
+        return len(self.graph)
+
+    def __call__(self, data=False, default=None):
+        if data is False:
+            return iter(self)
+        if data is True:
+            return ((node, self[node]) for node in self)
+        return ((node, self[node].get(data, default)) for node in self)
+
+
+class _ActivationNodeData(MutableMapping):
+    """The data of a node of an _ActivationGraph."""
+
+    def __init__(self, graph, node):
+        """Initialize the _ActivationNodeData.
+
+        Arguments:
+            graph (_ActivationGraph): The graph.
+            node (Hashable): The node.
+        """
+        self.graph = graph
+        self.node = node
+
+    def _data(self):
+        return self.graph.store.multigraph.nodes[self.node]
+
+    def _writable_data(self):
+        self.graph.store._writable('multigraph') # pylint: disable = protected-access
+        return self._data()
+
+    def __getitem__(self, key):
+        if key == 'activation':
+            return self.graph.activation(self.node)
+        return self._data()[key]
+
+    def __setitem__(self, key, value):
+        if key == 'activation':
+            self.graph.set_activation(self.node, value)
+        else:
+            self._writable_data()[key] = value
+
+    def __delitem__(self, key):
+        if key == 'activation':
+            self.graph.set_activation(self.node, [])
+        else:
+            del self._writable_data()[key]
+
+    def __iter__(self):
+        yield 'activation'
+        yield from self._data()
+
+    def __len__(self):
+        return len(self._data()) + 1
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class NetworkXKB(_LocalKnowledgeStore):
+    """A NetworkX implementation of a knowledge store.
+
+    Query results are ordered by activation, with ties going to the element
+    that was stored first. Retrieved elements are returned as ElementViews of
+    the graph rather than copies, so browsing results does not copy elements
+    that are not read.
+
+    Activations are kept in an OverlayMap beside the graph, relative to the
+    total decay so far, so that decaying every activation only changes that
+    total. Snapshots and forks therefore share the activations and only keep
+    their own changes. Forks also share the graph and its indexes until one of
+    them stores or evicts an element, at which point that fork copies them.
+    """
+
+    STRUCTURE = ('multigraph', 'inverted_index', 'ranks', 'budget', 'features')
+
+    def __init__(self, activation_fn=None, max_elements=None, max_bytes=None, memo_size=128):
+        """Initialize the NetworkXKB.
+
+        Arguments:
+            activation_fn (Callable[[networkx.MultiDiGraph, Hashable, List], None]):
+                Records an activation on a node. The graph is that of the
+                store, where graph.nodes[node]['activation'] is the list of
+                activations of a node. Defaults to doing nothing.
+            max_elements (int): The maximum number of elements to keep. Defaults to None.
+            max_bytes (int): The maximum approximate size of all elements. Defaults to None.
+            memo_size (int): The number of recent query matches to remember. Defaults to 128.
+        """
+        # parameters
+        if activation_fn is None:
+            activation_fn = (lambda graph, mem_id, activation: None)
+        self.activation_fn = activation_fn
+        # variables
+        self.multigraph = networkx.MultiDiGraph()
+        self.inverted_index = AttributeIndex(memo_size)
+        self.query_results = None
+        self.result_index = None
+        self.prev_match = None
+        self.time = 0
+        self.decay_rate = 0.5
+        self.decay_offset = 0 # the total decay so far
+        self.activations = OverlayMap() # node -> ActivationRecord
+        self.synced_activations = ()
+        self.budget = MemoryBudget(max_elements, max_bytes)
+        self.features = None
+        self.views = WeakValueDictionary()
+        self.ranks = {} # mem_id -> order of first store
+        self.next_rank = count()
+        self.shared = set()
+        self.num_removals = 0
+        self.clear()
+
+    def __getstate__(self):
+        # views are not copied; the views of a copy are created on demand
+        state = dict(self.__dict__)
+        del state['views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.views = WeakValueDictionary()
+
+    def getTime(self):
+        return self.time
+    def getDecayRate(self):
+        return self.decay_rate
+
+    # no [(3,0.5), (3, 1)], keep the higher one since it can't go any higher or lower
+    # sum from i to current time = (how long ago the event was) ^ -d(d changes depending on how fast the decay is)
+    # ^^ sorta have?
+
+    def update_neighbors(self, currNode, currentActivation, currentTime):
+        currNeighbors = self.multigraph.neighbors(currNode)
+        newActivation = round((currentActivation/2), 2)
+        for node in currNeighbors:
+            if node != currNode and newActivation > 0:
+                self._activate(node, [self.getTime(), newActivation])
+                self.update_neighbors(node, newActivation, currentTime)
+
+    def getActivation(self, nodeActivation, timePassed, decayRate):
+        decayAmount = round(pow(timePassed, decayRate * -1), 2)
+        newActivation = nodeActivation - decayAmount
+        return newActivation
+
+    def decay(self):
+        # every activation decays by the same amount, which is applied when
+        # activations are read
+        self.decay_offset = self.getActivation(self.decay_offset, self.getTime(), self.getDecayRate())
+
+    def activation(self, node):
+        """Get the activations of a node.
+
+        Arguments:
+            node (Hashable): The node.
+
+        Returns:
+            List[List[float]]: The time and the decayed value of each activation.
+        """
+        record = self.activations.get(node)
+        if record is None:
+            return []
+        return [[time, value + self.decay_offset] for time, value in record.entries]
+
+    def _copy_structure(self, name):
+        if name == 'multigraph':
+            # views of the old graph remain valid, since neither this
+            # store nor the fork will modify it again
+            self.views = WeakValueDictionary()
+            return self.multigraph.copy()
+        if name == 'ranks':
+            return dict(self.ranks)
+        return super()._copy_structure(name)
+
+    def clear(self): # noqa: D102
+        self._writable('inverted_index', 'budget')
+        # views of the old graph remain valid
+        self.multigraph = networkx.MultiDiGraph()
+        self.views = WeakValueDictionary()
+        self.inverted_index.clear()
+        self.ranks = {}
+        self.num_removals += 1
+        self.activations = OverlayMap()
+        self.synced_activations = ()
+        self.query_results = None
+        self.result_index = None
+        self.prev_match = None
+        self.budget.clear()
+        self.features = None
+        self.shared = set()
+
+    def store(self, mem_id=None, **kwargs): # noqa: D102
+        self._writable(*self.STRUCTURE)
+        if mem_id is None:
+            mem_id = uuid()
+        if mem_id not in self.ranks:
+            self.ranks[mem_id] = next(self.next_rank)
+        if mem_id not in self.multigraph:
+            self.multigraph.add_node(mem_id)
+            self.activations[mem_id] = ActivationRecord(
+                1, ((self.getTime(), 1 - self.decay_offset),),
+            )
+        else:
+            self._call_activation_fn(mem_id, [self.getTime(), 1])
+            if kwargs:
+                self._detach_view(mem_id)
+        for attribute, value in kwargs.items():
+            if value not in self.multigraph:
+                self.multigraph.add_node(value)
+                if value in self.activations:
+                    del self.activations[value]
+            self.multigraph.add_edge(mem_id, value, attribute=attribute)
+            self.inverted_index.add(mem_id, attribute, value)
+        if self.features is not None:
+            self.features.add(mem_id, kwargs.items(), self.getTime())
+        if self.budget.bounded:
+            num_bytes = getsizeof(mem_id) + sum(
+                getsizeof(data['attribute']) + getsizeof(value)
+                for _, value, data in self.multigraph.out_edges(mem_id, data=True)
+            )
+            self.budget.touch(mem_id, self._eviction_priority(mem_id), num_bytes)
+        self.update_neighbors(mem_id, 1, self.getTime())
+        self._sync_activations()
+        for victim in self.budget.victims(keep=mem_id):
+            self._evict(victim)
+        self.pass_time()
+        return True
+
+    @property
+    def graph(self):
+        """Get the graph of elements and values, with the activations of its nodes.
+
+        Changes to the activations of the nodes are only kept when they are
+        made by the activation function.
+
+        Returns:
+            _ActivationGraph: The graph.
+        """
+        return _ActivationGraph(self)
+
+    def _call_activation_fn(self, node, activation):
+        # activation_fn sees decayed values in a graph, which are then
+        # written back to the activation records of the nodes it read
+        graph = _ActivationGraph(self)
+        self.activation_fn(graph, node, activation)
+        stored = dict(graph.stored_activations())
+        for other, entries in stored.items():
+            record = self.activations.get(other, ActivationRecord(0, ()))
+            if other != node and entries != record.entries:
+                self.activations[other] = ActivationRecord(record.count, entries)
+        record = self.activations.get(node, ActivationRecord(0, ()))
+        self.activations[node] = ActivationRecord(record.count + 1, stored.get(node, record.entries))
+
+    def _activate(self, node, activation):
+        self._call_activation_fn(node, activation)
+
+    def _is_stored(self, mem_id):
+        return mem_id in self.ranks
+
+    def _eviction_priority(self, mem_id):
+        # the decayed activation values change every time step, so rank
+        # elements by the recency and then the frequency of their activations,
+        # which only change when the element itself is activated
+        record = self.activations.get(mem_id)
+        if record is None or not record.entries:
+            return (float('-inf'), 0)
+        return (max(time for time, _ in record.entries), len(record.entries))
+
+    def _num_activations(self, mem_id):
+        return self.activations[mem_id].count
+
+    def _evict(self, mem_id):
+        self._detach_view(mem_id)
+        del self.ranks[mem_id]
+        self.num_removals += 1
+        if self.features is not None:
+            self.features.remove(mem_id)
+        edges = list(self.multigraph.out_edges(mem_id, keys=True, data=True))
+        for _, value, key, data in edges:
+            self.multigraph.remove_edge(mem_id, value, key)
+            self.inverted_index.discard(mem_id, data['attribute'], value)
+        # drop the element node and any value nodes left without edges;
+        # nodes that are still elements or values of other elements remain
+        for node in set([mem_id, *(value for _, value, _, _ in edges)]):
+            if node in self.multigraph and node not in self.budget and self.multigraph.degree(node) == 0:
+                self.multigraph.remove_node(node)
+                if node in self.activations:
+                    del self.activations[node]
+                if node != mem_id:
+                    self.budget.stats['evicted_values'] += 1
+        if self.query_results is not None and mem_id in self.query_results:
+            # replace rather than modify the results, which snapshots may share
+            index = self.query_results.index(mem_id)
+            self.query_results = self.query_results[:index] + self.query_results[index + 1:]
+            if not self.query_results:
+                self.query_results = None
+                self.result_index = None
+            elif index < self.result_index or self.result_index == len(self.query_results):
+                self.result_index -= 1
+
+    def _result_key(self, mem_id):
+        # results are sorted by decreasing key; the stored activations differ
+        # from the decayed ones by the same amount, so they sort the same way
+        record = self.activations.get(mem_id)
+        return (() if record is None else record.entries, -self.ranks[mem_id])
+
+    def _activate_and_return(self, mem_id, activation):
+        self._activate(mem_id, activation)
+        return self._element(mem_id)
+
+    def _element(self, mem_id):
+        view = self.views.get(mem_id)
+        if view is None:
+            view = ElementView(self.multigraph, mem_id)
+            self.views[mem_id] = view
+        return view
+
+    def _detach_view(self, mem_id):
+        # copy the element into any view of it before its edges change
+        view = self.views.pop(mem_id, None)
+        if view is not None:
+            view.materialize()
+
+    def retrieve(self, mem_id): # noqa: D102
+        if mem_id not in self.multigraph:
+            return None
+        self.pass_time()
+        self.update_neighbors(mem_id, 1, self.getTime())
+        return self._activate_and_return(mem_id, [self.getTime(), 1])
+
+    def query(self, attr_vals): # noqa: D102
+        # refine the previous matches if possible, or scan the most
+        # selective attribute-value pair and filter by the rest
+        self.prev_match = self.inverted_index.match_set(attr_vals, self.prev_match)
+        candidates = self.prev_match.mem_ids
+        # quit early if there are no results
+        if not candidates:
+            self.query_results = None
+            self.result_index = None
+            return None
+        if self.query_results is not None:
+            curr_retrieved = self.query_results[self.result_index]
+        else:
+            curr_retrieved = None
+        # final pass: sort results by activation
+        self.query_results = sorted(candidates, key=self._result_key, reverse=True)
+        # keep the current result if it still matches the new query
+        if curr_retrieved in candidates:
+            self.result_index = self.query_results.index(curr_retrieved)
+        else:
+            self.result_index = 0
+        self.pass_time()
+        node = self.query_results[self.result_index]
+        return self._activate_and_return(node, [self.getTime(), 1])
+
+    def iter_query(self, attr_vals, limit=None): # noqa: D102
+        # yield elements in the same order as query() by popping them from a
+        # heap of the matches, so that only the elements that are read are
+        # ordered; activations must not change while the elements are yielded
+        heap = [
+            _Descending(self._result_key(mem_id), mem_id)
+            for mem_id in self.inverted_index.iter_match(attr_vals)
+        ]
+        heapify(heap)
+        num_results = 0
+        while heap and (limit is None or num_results < limit):
+            yield self._element(heappop(heap).value)
+            num_results += 1
+
+    def partial_query(self, attr_vals, k=10, activation_weight=0.0, mismatch_penalty=1.0): # noqa: D102
+        self._sync_activations()
+        if self.features is None:
+            self.features = FeatureMatrix()
+            for node in self.multigraph:
+                terms = [
+                    (data['attribute'], value)
+                    for _, value, data in self.multigraph.out_edges(node, data=True)
+                ]
+                if not terms:
+                    continue
+                record = self.activations.get(node, ActivationRecord(1, ()))
+                self.features.add(
+                    node, terms,
+                    min((time for time, _ in record.entries), default=self.getTime()),
+                    max(record.count, 1),
+                )
+            self.synced_activations = self.activations.freeze()
+            self.shared.discard('features')
+        self.prev_match = None
+        results = self.features.rank(
+            attr_vals, k=k,
+            activation_weight=activation_weight, mismatch_penalty=mismatch_penalty,
+            time=self.getTime(), decay=self.getDecayRate(),
+        )
+        if not results:
+            self.query_results = None
+            self.result_index = None
+            return None
+        self.query_results = results
+        self.result_index = 0
+        self.pass_time()
+        return self._activate_and_return(results[0], [self.getTime(), 1])
+
+    def explain(self, attr_vals): # noqa: D102
+        stages = self.inverted_index.explain(attr_vals)
+        candidates = self.inverted_index.match(attr_vals)
+        start = perf_counter()
+        sorted(candidates, key=self._result_key, reverse=True)
+        stages.append(QueryStage('sort', None, len(candidates), len(candidates), perf_counter() - start))
+        return stages
+
+    def pass_time(self, time=1):
+        self.time += time
+        self.decay()
 
 
     @property
@@ -579,6 +2528,40 @@ class NetworkXKB(KnowledgeStore):
     def retrievable(mem_id): # noqa: D102
         return isinstance(mem_id, Hashable)
 
+    def get_cursor(self): # noqa: D102
+        return (self.query_results, self.result_index, self.prev_match, self.num_removals)
+
+    def set_cursor(self, cursor): # noqa: D102
+        if cursor is None:
+            cursor = (None, None, None, self.num_removals)
+        query_results, result_index, self.prev_match, num_removals = cursor
+        query_results, self.result_index = self._live_results(query_results, result_index, num_removals)
+        self.query_results = query_results or None
+
+    def snapshot(self): # noqa: D102
+        return (self.activations.freeze(), self.decay_offset, self.time, self.get_cursor())
+
+    def restore(self, snapshot): # noqa: D102
+        activations, self.decay_offset, self.time, cursor = snapshot
+        restored = OverlayMap(activations)
+        # nodes added after the snapshot keep their activations, and nodes
+        # evicted after it stay evicted
+        for node in self.activations.changed(activations):
+            if node not in self.multigraph:
+                if node in restored:
+                    del restored[node]
+            elif node in self.activations and node not in restored:
+                restored[node] = self.activations[node]
+        self.activations = restored
+        self.set_cursor(cursor)
+
+    def fork(self): # noqa: D102
+        forked = copy(self)
+        forked.activations = self.activations.fork()
+        forked.views = WeakValueDictionary()
+        self._share_structure(forked)
+        return forked
+
 
 class SparqlKB(KnowledgeStore):
     """An adaptor for RL agents to use KnowledgeSources."""
@@ -591,14 +2574,19 @@ class SparqlKB(KnowledgeStore):
         '"NAN"^^<http://www.w3.org/2001/XMLSchema#float>',
     ])
 
+    PAGE_SIZE = 100
+
     def __init__(self, knowledge_source, augments=None):
         """Initialize a SparqlKB.
 
         Arguments:
-            knowledge_source (KnowledgeSource): A SPARQL knowledge source.
+            knowledge_source (Union[KnowledgeSource, str]): A SPARQL knowledge source,
+                or the URL of a SPARQL endpoint.
             augments (Sequence[Augment]): Additional values to add to results.
         """
         # parameters
+        if isinstance(knowledge_source, str):
+            knowledge_source = knowledge_base.SparqlEndpoint(knowledge_source)
         self.source = knowledge_source
         if augments is None:
             augments = []
@@ -627,20 +2615,26 @@ class SparqlKB(KnowledgeStore):
                 f'mem_id should be a str of the form "<http:.*>", '
                 f'but got: {mem_id}'
             )
-        if mem_id not in self.retrieve_cache:
-            result = self._true_retrieve(mem_id)
-            for augment in self.augments:
-                if all(attr in result for attr in augment.old_attrs):
-                    new_prop_val = augment.transform(result)
-                    if new_prop_val is not None:
-                        new_prop, new_val = new_prop_val
-                        result[new_prop] = new_val
-            self.retrieve_cache[mem_id] = TreeMultiMap.from_dict(result)
-        result = self.retrieve_cache[mem_id]
+        result = self._cached_retrieve(mem_id)
         self.prev_query = None
         self.query_offset = 0
         return result
 
+    def _cached_retrieve(self, mem_id):
+        if mem_id not in self.retrieve_cache:
+            self.retrieve_cache[mem_id] = self._augmented_retrieve(mem_id)
+        return self.retrieve_cache[mem_id]
+
+    def _augmented_retrieve(self, mem_id):
+        result = self._true_retrieve(mem_id)
+        for augment in self.augments:
+            if all(attr in result for attr in augment.old_attrs):
+                new_prop_val = augment.transform(result)
+                if new_prop_val is not None:
+                    new_prop, new_val = new_prop_val
+                    result[new_prop] = new_val
+        return TreeMultiMap.from_dict(result)
+
     def _true_retrieve(self, mem_id):
         query = f'''
         SELECT DISTINCT ?attr ?value WHERE {{
@@ -673,6 +2667,12 @@ class SparqlKB(KnowledgeStore):
             return self.retrieve(mem_id)
 
     def _true_query(self, attr_vals, offset=0):
+        results = self._query_page(attr_vals, offset=offset, limit=1)
+        if results:
+            return results[0]
+        return None
+
+    def _query_page(self, attr_vals, offset=0, limit=1):
         condition = ' ; '.join(
             f'{attr} {val}' for attr, val in attr_vals.items()
         )
@@ -680,13 +2680,28 @@ class SparqlKB(KnowledgeStore):
         SELECT DISTINCT ?concept WHERE {{
             ?concept {condition} ;
                      <http://xmlns.com/foaf/0.1/name> ?__name__ .
-        }} ORDER BY ?__name__ LIMIT 1 OFFSET {offset}
+        }} ORDER BY ?__name__ LIMIT {limit} OFFSET {offset}
         '''
         results = self.source.query_sparql(query)
-        try:
-            return next(iter(results))['concept'].rdf_format
-        except StopIteration:
-            return None
+        return [binding['concept'].rdf_format for binding in results]
+
+    def iter_query(self, attr_vals, limit=None): # noqa: D102
+        offset = 0
+        while limit is None or offset < limit:
+            page_size = self.PAGE_SIZE
+            if limit is not None:
+                page_size = min(page_size, limit - offset)
+            mem_ids = self._query_page(attr_vals, offset=offset, limit=page_size)
+            for mem_id in mem_ids:
+                # streamed elements are not added to the cache, which would
+                # otherwise grow with every element streamed
+                result = self.retrieve_cache.get(mem_id)
+                if result is None:
+                    result = self._augmented_retrieve(mem_id)
+                yield result
+            if len(mem_ids) < page_size:
+                return
+            offset += page_size
 
     @property
     def has_prev_result(self): # noqa: D102
@@ -711,3 +2726,316 @@ class SparqlKB(KnowledgeStore):
     @staticmethod
     def retrievable(mem_id): # noqa: D102
         return isinstance(mem_id, str) and mem_id.startswith('<http')
+
+    def get_cursor(self): # noqa: D102
+        return (self.prev_query, self.query_offset)
+
+    def set_cursor(self, cursor): # noqa: D102
+        if cursor is None:
+            cursor = (None, 0)
+        self.prev_query, self.query_offset = cursor
+
+    def snapshot(self): # noqa: D102
+        return self.get_cursor()
+
+    def restore(self, snapshot): # noqa: D102
+        self.set_cursor(snapshot)
+
+    def fork(self): # noqa: D102
+        # the forks share the endpoint and the caches
+        return copy(self)
+
+
+KNOWLEDGE_STORE_ENTRY_POINTS = 'research.knowledge_stores'
+
+_KNOWLEDGE_STORES = {
+    'naive-dict': NaiveDictKB,
+    'networkx': NetworkXKB,
+    'sparql': SparqlKB,
+}
+
+
+def register_knowledge_store(name, factory):
+    """Register a knowledge store under a name.
+
+    Arguments:
+        name (str): The name of the knowledge store.
+        factory (Union[Callable[..., KnowledgeStore], str]): A callable that
+            creates the knowledge store, or its location as "module:attribute",
+            in which case the module is only imported when the store is created.
+    """
+    _KNOWLEDGE_STORES[name] = factory
+
+
+def create_knowledge_store(name, *args, **kwargs):
+    """Create a knowledge store by its registered name.
+
+    Stores that are not registered with register_knowledge_store() are looked
+    up in the "research.knowledge_stores" entry point group.
+
+    Arguments:
+        name (str): The name of the knowledge store.
+        *args: Arbitrary positional arguments for the knowledge store.
+        **kwargs: Arbitrary keyword arguments for the knowledge store.
+
+    Returns:
+        KnowledgeStore: The new knowledge store.
+
+    Raises:
+        ValueError: If no knowledge store has that name.
+    """
+    if name not in _KNOWLEDGE_STORES:
+        metadata = import_module('importlib.metadata')
+        for entry_point in metadata.entry_points(group=KNOWLEDGE_STORE_ENTRY_POINTS):
+            if entry_point.name == name:
+                _KNOWLEDGE_STORES[name] = entry_point.load()
+                break
+        else:
+            raise ValueError(f'no knowledge store is registered as {name}')
+    factory = _KNOWLEDGE_STORES[name]
+    if isinstance(factory, str):
+        module_name, attribute = factory.split(':')
+        factory = getattr(import_module(module_name), attribute)
+        _KNOWLEDGE_STORES[name] = factory
+    return factory(*args, **kwargs)
+
+
+LoggedCall = namedtuple('LoggedCall', 'method, args, kwargs, result, seconds')
+SavedState = namedtuple('SavedState', 'number, state')
+ReplayReport = namedtuple('ReplayReport', 'calls, seconds, throughput, percentiles, recorded_percentiles, mismatches')
+
+
+def _open_log(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _fork_log_path(path, fork_num):
+    path = str(path)
+    if path.endswith('.gz'):
+        return f'{path[:-3]}.fork{fork_num}.gz'
+    return f'{path}.fork{fork_num}'
+
+
+def _loggable(value):
+    # mappings (such as query buffers and results) are logged as their items
+    # so that results from different stores can be compared
+    if hasattr(value, 'items'):
+        return tuple(value.items())
+    return value
+
+
+def _percentiles(latencies, percentiles):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {percentile: None for percentile in percentiles}
+    return {
+        percentile: latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+        for percentile in percentiles
+    }
+
+
+class RecordingKB(KnowledgeStore):
+    """A wrapper that logs all calls to another knowledge store.
+
+    Each call is appended to the log as a pickled LoggedCall, with the
+    arguments, the result, and the time it took. The log can be replayed
+    against any knowledge store with replay_kb_log(). Forks are recorded to
+    their own logs, named after this log with a fork number appended.
+
+    Cursors and snapshots are returned as SavedStates, and logged only by
+    their number, so that the replayed store restores its own states. They
+    can only be replayed in the log in which they were saved.
+    """
+
+    def __init__(self, knowledge_store, log_path):
+        """Initialize the RecordingKB.
+
+        Arguments:
+            knowledge_store (KnowledgeStore): The store to record.
+            log_path (str): The file to write the log to. Compressed if it ends in ".gz".
+        """
+        self.knowledge_store = knowledge_store
+        self.log_path = log_path
+        self.log_file = _open_log(log_path, 'wb')
+        self.num_forks = 0
+        self.num_saved = 0
+
+    def close(self):
+        """Finish writing the log."""
+        self.log_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record(self, method, *args, **kwargs):
+        start = perf_counter()
+        attribute = getattr(self.knowledge_store, method)
+        if args or kwargs or callable(attribute):
+            result = attribute(*args, **kwargs)
+        else:
+            result = attribute
+            args = None
+        seconds = perf_counter() - start
+        self._log(LoggedCall(
+            method,
+            None if args is None else tuple(_loggable(arg) for arg in args),
+            kwargs,
+            _loggable(result),
+            seconds,
+        ))
+        return result
+
+    def _record_save(self, method):
+        self.num_saved += 1
+        start = perf_counter()
+        state = getattr(self.knowledge_store, method)()
+        self._log(LoggedCall(method, (), {}, self.num_saved, perf_counter() - start))
+        return SavedState(self.num_saved, state)
+
+    def _record_load(self, method, saved):
+        number, state = (None, None) if saved is None else saved
+        start = perf_counter()
+        getattr(self.knowledge_store, method)(state)
+        self._log(LoggedCall(method, (number,), {}, None, perf_counter() - start))
+
+    def _log(self, call):
+        pickle.dump(call, self.log_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def clear(self): # noqa: D102
+        self._record('clear')
+
+    def store(self, mem_id=None, **kwargs): # noqa: D102
+        return self._record('store', mem_id, **kwargs)
+
+    def retrieve(self, mem_id): # noqa: D102
+        return self._record('retrieve', mem_id)
+
+    def query(self, attr_vals): # noqa: D102
+        return self._record('query', attr_vals)
+
+    def explain(self, attr_vals): # noqa: D102
+        return self.knowledge_store.explain(attr_vals)
+
+    def iter_query(self, attr_vals, limit=None): # noqa: D102
+        # streamed results are not recorded
+        return self.knowledge_store.iter_query(attr_vals, limit=limit)
+
+    def partial_query(self, attr_vals, k=10, activation_weight=0.0, mismatch_penalty=1.0): # noqa: D102
+        return self._record(
+            'partial_query', attr_vals,
+            k=k, activation_weight=activation_weight, mismatch_penalty=mismatch_penalty,
+        )
+
+    @property
+    def has_prev_result(self): # noqa: D102
+        return self._record('has_prev_result')
+
+    def prev_result(self): # noqa: D102
+        return self._record('prev_result')
+
+    @property
+    def has_next_result(self): # noqa: D102
+        return self._record('has_next_result')
+
+    def next_result(self): # noqa: D102
+        return self._record('next_result')
+
+    def retrievable(self, mem_id): # noqa: D102
+        # pylint: disable = arguments-differ
+        return self.knowledge_store.retrievable(mem_id)
+
+    def get_cursor(self): # noqa: D102
+        return self._record_save('get_cursor')
+
+    def set_cursor(self, cursor): # noqa: D102
+        self._record_load('set_cursor', cursor)
+
+    def snapshot(self): # noqa: D102
+        return self._record_save('snapshot')
+
+    def restore(self, snapshot): # noqa: D102
+        self._record_load('restore', snapshot)
+
+    def fork(self): # noqa: D102
+        self.num_forks += 1
+        return RecordingKB(
+            self.knowledge_store.fork(),
+            _fork_log_path(self.log_path, self.num_forks),
+        )
+
+
+def read_kb_log(log_path):
+    """Read the calls recorded by a RecordingKB.
+
+    Arguments:
+        log_path (str): The log file.
+
+    Yields:
+        LoggedCall: The recorded calls, in order.
+    """
+    with _open_log(log_path, 'rb') as log_file:
+        while True:
+            try:
+                yield pickle.load(log_file)
+            except EOFError:
+                return
+
+
+def replay_kb_log(log_path, knowledge_store, percentiles=(50, 90, 99)):
+    """Replay a recorded log against a knowledge store.
+
+    The calls are made back to back, and each result is compared with the
+    recorded result. Cursors and snapshots saved during the replay take the
+    place of the recorded ones; restoring one that was not saved in this log
+    is a mismatch.
+
+    Arguments:
+        log_path (str): The log file written by a RecordingKB.
+        knowledge_store (KnowledgeStore): The store to replay against.
+        percentiles (Sequence[int]): The latency percentiles to report.
+
+    Returns:
+        ReplayReport: The throughput, latencies, and mismatched calls.
+    """
+    latencies = []
+    recorded_latencies = []
+    mismatches = []
+    saved = {} # number -> state
+    for index, call in enumerate(read_kb_log(log_path)):
+        start = perf_counter()
+        if call.method in ('get_cursor', 'snapshot'):
+            saved[call.result] = getattr(knowledge_store, call.method)()
+            result = call.result
+        elif call.method in ('set_cursor', 'restore'):
+            number = call.args[0]
+            if number is not None and number not in saved:
+                mismatches.append((index, call, None))
+                continue
+            result = getattr(knowledge_store, call.method)(saved.get(number))
+        elif call.args is None:
+            result = getattr(knowledge_store, call.method)
+        else:
+            args = tuple(
+                dict(arg) if call.method in ('query', 'partial_query') else arg
+                for arg in call.args
+            )
+            result = getattr(knowledge_store, call.method)(*args, **call.kwargs)
+        latencies.append(perf_counter() - start)
+        recorded_latencies.append(call.seconds)
+        result = _loggable(result)
+        if result != call.result:
+            mismatches.append((index, call, result))
+    seconds = sum(latencies)
+    return ReplayReport(
+        len(latencies),
+        seconds,
+        (len(latencies) / seconds if seconds else None),
+        _percentiles(latencies, percentiles),
+        _percentiles(recorded_latencies, percentiles),
+        mismatches,
+    )
@@ -2,7 +2,9 @@
 """Tests for RL memory code."""
 
 import sys
-from os.path import dirname, realpath
+from multiprocessing import AuthenticationError
+from os.path import dirname, realpath, join as join_path
+from tempfile import TemporaryDirectory
 
 DIRECTORY = dirname(realpath(__file__))
 sys.path.insert(0, dirname(DIRECTORY))
@@ -11,6 +13,9 @@ sys.path.insert(0, dirname(DIRECTORY))
 from research.knowledge_base import SparqlEndpoint
 from research.rl_environments import State, Action, Environment
 from research.rl_memory import memory_architecture, NaiveDictKB, NetworkXKB, SparqlKB
+from research.rl_memory import RecordingKB, replay_kb_log
+from research.rl_memory import register_knowledge_store, create_knowledge_store
+from research.kb_server import KnowledgeStoreServer, KnowledgeStoreClient, Request
 from datetime import datetime
 
 
@@ -135,10 +140,101 @@ def test_memory_architecture():
         retrieval_row=1,
         retrieval_col=0,
     ), env.get_observation()
+    # snapshot test
+    snapshot = env.snapshot()
+    env.react(Action('next-result'))
+    env.react(Action('delete', buf='query', attr='row'))
+    env.restore(snapshot)
+    assert env.get_observation() == State(
+        perceptual_index=0,
+        query_row=1,
+        retrieval_index=5,
+        retrieval_row=1,
+        retrieval_col=0,
+    ), env.get_observation()
+    env.react(Action('next-result'))
+    assert env.get_observation() == State(
+        perceptual_index=0,
+        query_row=1,
+        retrieval_index=6,
+        retrieval_row=1,
+        retrieval_col=1,
+    ), env.get_observation()
+    env.restore(snapshot)
+    # fork test
+    env.history = []
+    forked = env.fork()
+    forked.history.append(Action('next-result'))
+    assert not env.history and forked.codec is env.codec
+    forked.react(Action('next-result'))
+    forked.add_to_ltm(index=99, row=99, col=99)
+    assert forked.get_observation()['retrieval_index'] == 6, forked.get_observation()
+    assert env.get_observation() == State(
+        perceptual_index=0,
+        query_row=1,
+        retrieval_index=5,
+        retrieval_row=1,
+        retrieval_col=0,
+    ), env.get_observation()
+    assert not list(env.knowledge_store.iter_query({'index': 99}))
+    assert len(list(forked.knowledge_store.iter_query({'index': 99}))) == 1
+    # integer codec test
+    action_ids = env.get_action_ids()
+    assert (
+        set(env.codec.decode_action(i) for i in action_ids) == set(env.get_actions())
+    ), action_ids
+    mask = env.get_action_mask()
+    assert mask.sum() == len(action_ids) and mask[action_ids].all(), mask
+    next_id = env.codec.encode_action(Action('next-result'))
+    assert next_id in action_ids and (env.get_action_ids() == action_ids).all()
+    env.react(int(next_id))
+    assert env.get_observation()['retrieval_index'] == 6, env.get_observation()
+    assert env.get_action_mask().shape == (env.codec.num_actions,)
+    assert env.get_action_mask(size=100).shape == (100,)
+    try:
+        env.get_action_mask(size=1)
+        assert False
+    except ValueError:
+        pass
+    observation_ids = env.get_observation_ids()
+    assert (
+        set(env.codec.decode_slot(i) for i in observation_ids) == set(env.slots)
+    ), observation_ids
+    assert env.codec.encode_slot(('retrieval', 'index', 6)) in observation_ids
+    env.restore(snapshot)
     # complete the environment
     reward = env.react(Action('-1'))
     assert env.end_of_episode()
     assert reward == 100, reward
+    # browsing NetworkXKB results does not copy them
+    env = memory_architecture(TestEnv)(
+        knowledge_store=NetworkXKB(),
+        size=size,
+        index=0,
+    )
+    env.start_new_episode()
+    for i in range(size * size):
+        env.add_to_ltm(index=i, row=(i // size), col=(i % size))
+    env.react(Action('5'))
+    env.react(Action('copy', src_buf='perceptual', src_attr='index', dst_buf='query', dst_attr='index'))
+    env.react(Action('copy', src_buf='retrieval', src_attr='row', dst_buf='query', dst_attr='row'))
+    env.react(Action('delete', buf='query', attr='index'))
+    if env.knowledge_store.has_next_result:
+        env.react(Action('next-result'))
+    else:
+        env.react(Action('prev-result'))
+    assert env.get_observation()['retrieval_row'] == 1, env.get_observation()
+    assert len(env.get_action_ids()) == len(env.get_actions())
+    assert env.buffers['retrieval'].multimap is None
+    # forks share the long-term memory but not the cursor or activations
+    observation = env.get_observation()
+    forked = env.fork()
+    assert forked.knowledge_store.multigraph is env.knowledge_store.multigraph
+    forked.react(Action('delete', buf='query', attr='row'))
+    forked.react(Action('copy', src_buf='perceptual', src_attr='index', dst_buf='query', dst_attr='index'))
+    assert forked.get_observation()['retrieval_index'] == 5, forked.get_observation()
+    assert env.get_observation() == observation, env.get_observation()
+    assert forked.knowledge_store.multigraph is env.knowledge_store.multigraph
 
 
 def test_networkxkb():
@@ -185,13 +281,412 @@ def test_networkxkb():
     result = store.prev_result()
     assert result['name'] == 'whale'
     assert not store.has_prev_result
+    # query plan
+    stages = store.explain({'is_a': 'mammal', 'name': 'cat'})
+    assert [stage.operation for stage in stages] == ['scan', 'filter', 'sort'], stages
+    assert stages[0].term == ('name', 'cat'), stages
+    assert stages[0].actual == 1 and stages[1].actual == 1, stages
     iterator = store.graph.__iter__()
     for node in iterator:
         print(node + ":", (store.graph.nodes.get(node)['activation']))
 
 
 
+def test_networkxkb_eviction():
+    """Test evicting low-activation elements from the NetworkX KnowledgeStore."""
+
+    def activation_fn(graph, mem_id, activation):
+        graph.nodes[mem_id]['activation'].append(activation)
+
+    store = NetworkXKB(activation_fn=activation_fn, max_elements=2)
+    store.store('cat', is_a='mammal', name='cat')
+    store.store('bear', is_a='mammal', has='claws', name='bear')
+    store.retrieve('cat') # this activates cat, leaving bear as the least active
+    store.store('whale', is_a='mammal', lives_in='water')
+    assert 'bear' not in store.graph
+    assert 'claws' not in store.graph
+    assert store.inverted_index.cardinality('has') == 0
+    assert store.query({'name': 'bear'}) is None
+    result = store.query({'is_a': 'mammal'})
+    assert result is not None
+    assert store.has_next_result
+    store.next_result()
+    assert not store.has_next_result
+    stats = store.eviction_stats
+    assert stats['elements'] == 2, stats
+    assert stats['evicted_elements'] == 1, stats
+    assert stats['evicted_values'] == 1, stats
+
+
+def test_networkxkb_snapshot():
+    """Test restoring the activations and cursor of the NetworkX KnowledgeStore."""
+
+    def activation_fn(graph, mem_id, activation):
+        graph.nodes[mem_id]['activation'].append(activation)
+
+    store = NetworkXKB(activation_fn=activation_fn)
+    for i in range(5):
+        store.store(f'e{i}', group=0, index=i)
+    result = store.query({'group': 0})
+    store.next_result()
+    snapshot = store.snapshot()
+    activations = {node: store.activation(node) for node in store.graph}
+    expected = store.next_result()['index']
+    for _ in range(2):
+        store.restore(snapshot)
+        # the activations are exactly as they were
+        for node, activation in activations.items():
+            assert store.activation(node) == activation, (node, store.activation(node), activation)
+        # the cursor is back where it was
+        assert store.has_prev_result
+        assert store.next_result()['index'] == expected
+        store.retrieve('e4')
+        store.query({'index': 2})
+        store.store('e5', group=0, index=5)
+    # elements stored after the snapshot remain, with their activations
+    store.restore(snapshot)
+    assert store.activation('e5')
+    assert store.query({'index': 5})['index'] == 5
+
+
+def test_networkxkb_activation_fn():
+    """Test the graph given to the activation function of the NetworkX KnowledgeStore."""
+
+    def activation_fn(graph, mem_id, activation):
+        graph.nodes[mem_id]['activation'].append(activation)
+        # activations can spread along the edges of the graph
+        for _, value, data in graph.out_edges(mem_id, data=True):
+            if data['attribute'] == 'friend':
+                graph.nodes[value]['activation'].append([activation[0], activation[1] / 4])
+
+    store = NetworkXKB(activation_fn=activation_fn)
+    store.store('alice', name='Alice')
+    store.store('bob', name='Bob', friend='alice')
+    assert set(store.graph.neighbors('bob')) == {'Bob', 'alice'}
+    store.retrieve('bob')
+    time = store.getTime()
+    assert [time, 1] in store.graph.nodes['bob']['activation']
+    assert any(
+        entry_time == time and abs(value - 0.25) < 1e-9
+        for entry_time, value in store.graph.nodes.get('alice')['activation']
+    ), store.activation('alice')
+
+
+def test_restore_after_eviction():
+    """Test restoring bounded KnowledgeStores after elements were evicted."""
+    for store in [NaiveDictKB(max_elements=3), NetworkXKB(max_elements=3)]:
+        env = memory_architecture(Environment)(knowledge_store=store)
+        for i in range(3):
+            env.add_to_ltm(mem_id=f'e{i}', group=0, index=i)
+        store.query({'group': 0})
+        snapshot = env.snapshot()
+        env.add_to_ltm(mem_id='e3', group=0, index=3)
+        assert store.eviction_stats['evicted_elements'] == 1, store.eviction_stats
+        env.restore(snapshot)
+        # the evicted element is no longer a result
+        indices = set()
+        for _ in range(3):
+            result = store.next_result() if store.has_next_result else store.prev_result()
+            assert result and result['group'] == 0, result
+            indices.add(result['index'])
+        assert len(indices) == 2 and 3 not in indices, indices
+        assert len(list(store.iter_query({'group': 0}))) == 3
+    # and does not get its activations back
+    evicted = [f'e{i}' for i in range(3) if i not in indices]
+    assert len(evicted) == 1 and evicted[0] not in store.graph, evicted
+    assert evicted[0] not in store.activations and not store.activation(evicted[0])
+
+
+def test_fork():
+    """Test forking the local KnowledgeStores."""
+    for store in [NaiveDictKB(max_elements=5), NetworkXKB(max_elements=5)]:
+        for i in range(5):
+            store.store(f'cell{i}', index=i, row=0)
+        store.query({'row': 0})
+        fork = store.fork()
+        # evictions and new elements in the fork do not affect the store
+        fork.store('cell5', index=5, row=0)
+        fork.store('cell6', index=6, row=1)
+        assert fork.query({'index': 5})['index'] == 5
+        assert not list(store.iter_query({'index': 5}))
+        indices = [store.next_result()['index'] for _ in range(4)]
+        assert len(set(indices)) == 4 and set(indices) <= set(range(5)), indices
+        assert store.eviction_stats['evicted_elements'] == 0, store.eviction_stats
+        assert fork.eviction_stats['evicted_elements'] == 2, fork.eviction_stats
+    # NetworkXKB forks share the graph until they store elements
+    fork = store.fork()
+    assert fork.multigraph is store.multigraph
+    fork.retrieve('cell1')
+    assert fork.multigraph is store.multigraph
+    assert fork.activation('cell1') != store.activation('cell1')
+    fork.store('cell7', index=7, row=0)
+    assert fork.multigraph is not store.multigraph and 'cell7' not in store.graph
+
+
+def test_networkxkb_views():
+    """Test that the NetworkX KnowledgeStore returns views that are stable."""
+
+    def activation_fn(graph, mem_id, activation):
+        graph.nodes[mem_id]['activation'].append(activation)
+
+    store = NetworkXKB(activation_fn=activation_fn, max_elements=2)
+    store.store('cat', is_a='mammal', name='cat')
+    store.store('bear', is_a='mammal', name='bear')
+    result = store.query({'name': 'cat'})
+    assert result.multimap is None
+    assert result['is_a'] == 'mammal' and 'name' in result and 'has' not in result
+    assert result.multimap is None
+    assert store.retrieve('cat') is result
+    assert sorted(result.items()) == [('is_a', 'mammal'), ('name', 'cat')], result
+    assert list(result) == ['is_a', 'name'] and result.multimap is None
+    # changing the element copies it into the view first
+    store.store('cat', has='claws')
+    assert result.multimap is not None
+    assert 'has' not in result and store.retrieve('cat')['has'] == 'claws'
+    # copies of the store do not share views
+    fork = store.fork()
+    fork.store('bear', name='grizzly')
+    assert store.retrieve('bear').get('name') == 'bear'
+    # evicting the element copies it too
+    cat = store.retrieve('cat')
+    assert cat.multimap is None
+    store.retrieve('bear')
+    store.store('whale', is_a='mammal')
+    assert 'cat' not in store.graph
+    assert sorted(cat.items()) == [('has', 'claws'), ('is_a', 'mammal'), ('name', 'cat')], cat
+
+
+def test_partial_query():
+    """Test partial matching in the local KnowledgeStores."""
+    size = 5
+    for store in [NaiveDictKB(), NetworkXKB()]:
+        for i in range(size * size):
+            store.store(f'cell{i}', index=i, row=(i // size), col=(i % size))
+        # no exact match
+        assert store.query({'index': 7, 'row': 1, 'col': 9}) is None
+        # the only best partial match shares two attributes
+        result = store.partial_query({'index': 7, 'row': 1, 'col': 9}, k=3)
+        assert sorted(result.items()) == [('col', 2), ('index', 7), ('row', 1)], result
+        # the rest share only the row
+        for _ in range(2):
+            result = store.next_result()
+            assert result['row'] == 1 and result['index'] != 7, result
+        # nothing shares any attributes
+        assert store.partial_query({'index': 99}) is None
+
+
+def test_iter_query():
+    """Test streaming query results from the local KnowledgeStores."""
+    size = 5
+    for store in [NaiveDictKB(), NetworkXKB()]:
+        for i in range(size * size):
+            store.store(f'cell{i}', index=i, row=(i // size), col=(i % size))
+        result = store.query({'row': 2})
+        results = list(store.iter_query({'row': 1}))
+        assert sorted(result['index'] for result in results) == [5, 6, 7, 8, 9], results
+        assert len(list(store.iter_query({'row': 1}, limit=2))) == 2
+        assert not list(store.iter_query({'row': 1, 'col': 7}))
+        # the cursor is not affected
+        assert store.next_result()['row'] == 2
+    # NetworkXKB yields results in the same order as query()
+    results = [result['index'] for result in store.iter_query({'col': 3})]
+    assert store.query({'col': 7}) is None
+    result = store.query({'col': 3})
+    assert result['index'] == results[0], (result, results)
+    for index in results[1:]:
+        assert store.next_result()['index'] == index
+    # ties go to the element stored first
+    store = NetworkXKB()
+    for i in range(7):
+        store.store(f'e{i}', group=0, index=i)
+    for i in range(7):
+        store.activations[f'e{i}'] = store.activations['e0']
+    results = [result['index'] for result in store.iter_query({'group': 0})]
+    assert results == list(range(7)), results
+    assert [result['index'] for result in store.iter_query({'group': 0}, limit=3)] == [0, 1, 2]
+    assert store.query({'group': 0})['index'] == 0
+    # each match is keyed once, however many results are read
+    for num_matches in [100, 1000]:
+        store = NetworkXKB()
+        for i in range(num_matches):
+            store.store(f'e{i}', group=0, index=i)
+        num_keys = 0
+        result_key = store._result_key
+        def counting_result_key(mem_id):
+            nonlocal num_keys
+            num_keys += 1
+            return result_key(mem_id)
+        store._result_key = counting_result_key
+        results = [result['index'] for result in store.iter_query({'group': 0})]
+        assert results == sorted(results, reverse=True), results
+        assert num_keys == num_matches, (num_keys, num_matches)
+
+
+def test_query_memo():
+    """Test memoizing query matches in the local KnowledgeStores."""
+    size = 5
+    for store in [NaiveDictKB(memo_size=2), NetworkXKB(memo_size=2)]:
+        for i in range(size * size):
+            store.store(f'cell{i}', index=i, row=(i // size), col=(i % size))
+        store.query({'row': 1})
+        store.query({'row': 1, 'col': 2})
+        store.query({'row': 1})
+        stats = store.memo_stats
+        assert (stats['hits'], stats['misses'], stats['size']) == (1, 2, 2), stats
+        # storing a matching element invalidates the memoized matches
+        store.store('extra', row=1, col=size)
+        results = list(store.iter_query({'row': 1}))
+        store.query({'row': 1})
+        assert store.memo_stats['misses'] == 3, store.memo_stats
+        assert len(results) == size + 1, results
+
+
+def test_unhashable_values():
+    """Test storing and querying unhashable values in the NaiveDictKB."""
+    store = NaiveDictKB(max_elements=3)
+    store.store(name='a', tags=['x', 'y'])
+    store.store(name='b', tags=['x'])
+    store.store(name='c', tags=['x', 'y'])
+    result = store.query({'tags': ['x', 'y']})
+    assert result['name'] == 'a', result
+    assert store.next_result()['name'] == 'c'
+    assert [result['name'] for result in store.iter_query({'tags': ['x'], 'name': 'b'})] == ['b']
+    assert store.explain({'tags': ['x', 'y']})[0].actual == 2
+    assert store.partial_query({'name': 'b', 'tags': ['x', 'y']})['name'] == 'b'
+    # elements with unhashable values can be evicted
+    store.store(name='d', tags=[])
+    assert store.eviction_stats['evicted_elements'] == 1, store.eviction_stats
+    assert len(list(store.iter_query({}))) == 3
+    assert store.inverted_index.cardinality('tags') == 3
+
+
+def test_knowledge_store_registry():
+    """Test creating KnowledgeStores by name."""
+    assert isinstance(create_knowledge_store('naive-dict'), NaiveDictKB)
+    store = create_knowledge_store('networkx', max_elements=10)
+    assert isinstance(store, NetworkXKB)
+    assert store.budget.max_elements == 10
+    register_knowledge_store('lazy-naive-dict', 'research.rl_memory:NaiveDictKB')
+    assert isinstance(create_knowledge_store('lazy-naive-dict'), NaiveDictKB)
+    try:
+        create_knowledge_store('no-such-store')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_kb_server():
+    """Test sharing a KnowledgeStore between clients."""
+    size = 5
+    with TemporaryDirectory() as temp_dir:
+        address = join_path(temp_dir, 'kb.sock')
+        server = KnowledgeStoreServer(NetworkXKB(), address).start()
+        writer = KnowledgeStoreClient(address, server.authkey)
+        for i in range(size * size):
+            writer.store(f'cell{i}', index=i, row=(i // size), col=(i % size))
+        env = memory_architecture(Environment)(
+            knowledge_store=KnowledgeStoreClient(address, server.authkey),
+        )
+        assert env.knowledge_store.retrievable('cell0')
+        # each client has its own cursor
+        reader = writer.fork()
+        assert writer.query({'row': 1})['row'] == 1
+        assert reader.query({'col': 1})['col'] == 1
+        assert writer.has_next_result
+        assert writer.next_result()['row'] == 1
+        assert reader.next_result()['col'] == 1
+        assert len(list(reader.iter_query({'col': 1}))) == size
+        # errors are raised in the client
+        try:
+            writer.query(None)
+            assert False
+        except AttributeError:
+            pass
+        # clients without the authkey are rejected
+        try:
+            KnowledgeStoreClient(address, b'not the authkey')
+            assert False
+        except AuthenticationError:
+            pass
+        for client in (writer, reader, env.knowledge_store):
+            client.close()
+        server.shutdown()
+
+    # identical reads in a batch are only run once
+    class Connection:
+        """A connection that keeps the responses it is sent."""
+
+        def __init__(self):
+            """Initialize the Connection."""
+            self.responses = []
+
+        def send(self, response):
+            """Keep a response.
+
+            Arguments:
+                response (Tuple[bool, Any]): The response.
+            """
+            self.responses.append(response)
+
+    server = KnowledgeStoreServer(server.knowledge_store, None)
+    clients = [Connection() for _ in range(3)]
+    for client in clients:
+        server.requests.put(Request(client, 'iter_query', ({'row': 1},), {}))
+    server.requests.put(Request(clients[0], 'query', ({'row': 2},), {}))
+    server.requests.put(Request(clients[1], 'iter_query', ({'row': 1},), {}))
+    server.requests.put(None)
+    server._dispatch() # pylint: disable = protected-access
+    assert server.num_batches == 1 and server.num_shared == 2, server.num_shared
+    assert clients[1].responses[0] == clients[0].responses[0]
+    assert len(clients[1].responses[0][1]) == size
+    # the cursors of other clients skip elements evicted by a client
+    server = KnowledgeStoreServer(NaiveDictKB(max_elements=3), None)
+    writer, reader = Connection(), Connection()
+    for i in range(3):
+        server.requests.put(Request(writer, 'store', (f'e{i}',), {'group': 0, 'index': i}))
+    server.requests.put(Request(reader, 'query', ({'group': 0},), {}))
+    server.requests.put(Request(writer, 'store', ('e3',), {'group': 0, 'index': 3}))
+    for _ in range(3):
+        server.requests.put(Request(reader, 'next_result', (), {}))
+    server.requests.put(None)
+    server._dispatch() # pylint: disable = protected-access
+    assert all(success for success, _ in reader.responses), reader.responses
+    indices = set(result['index'] for _, result in reader.responses)
+    assert len(indices) == 2 and 3 not in indices, indices
+
 
+def test_kb_log_replay():
+    """Test recording and replaying calls to a KnowledgeStore."""
+    with TemporaryDirectory() as temp_dir:
+        log_path = join_path(temp_dir, 'networkxkb.log.gz')
+        with RecordingKB(NetworkXKB(), log_path) as store:
+            store.store('cat', is_a='mammal', name='cat')
+            store.store('bear', is_a='mammal', name='bear')
+            store.query({'is_a': 'mammal'})
+            cursor = store.get_cursor()
+            snapshot = store.snapshot()
+            while store.has_next_result:
+                store.next_result()
+            # restoring cursors and snapshots is replayed too
+            store.restore(snapshot)
+            store.set_cursor(cursor)
+            assert store.has_next_result
+            store.set_cursor(None)
+        report = replay_kb_log(log_path, NetworkXKB())
+        assert report.calls == 12, report
+        assert not report.mismatches, report.mismatches
+        report = replay_kb_log(log_path, NaiveDictKB())
+        assert report.mismatches, report
+        # forks are recorded to their own logs
+        with RecordingKB(NetworkXKB(), log_path) as store:
+            store.store('cat', is_a='mammal', name='cat')
+            with store.fork() as fork:
+                assert fork.log_path == join_path(temp_dir, 'networkxkb.log.fork1.gz')
+                fork.store('bear', is_a='mammal', name='bear')
+                fork.query({'is_a': 'mammal'})
+        assert replay_kb_log(log_path, NetworkXKB()).calls == 1
+        report = replay_kb_log(fork.log_path, NetworkXKB())
+        assert report.calls == 2, report
 
 
 def test_sparqlkb():